@@ -0,0 +1,418 @@
+#! /usr/bin/env python3
+
+"""Measure the overhead of the installers without a cloud account or network access
+
+Runs install-citc.py, destroy-citc.py and the Google install_citc.py/destroy_citc.py end
+to end against stub.py stand-ins for terraform, aws, gcloud, ssh, scp and ssh-keygen. The
+configuration archive and Terraform release are served from a local HTTP server and
+the management node's SSH port by a local banner server. Each stand-in sleeps for a
+configurable latency so the timings reflect how the installers order and overlap
+their work rather than how fast the cloud is. The HTTP server honours byte ranges
+and can drop connections, so the shared download code is also timed through
+dropped connections and an interrupted download which is later resumed.
+
+The time of each phase is compared with baseline.json and the run fails if any has
+regressed by more than the tolerance.
+"""
+
+import argparse
+import contextlib
+import functools
+import hashlib
+import http.server
+import importlib.util
+import io
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+GOOGLE_DIR = os.path.join(REPO_DIR, "docker", "google-base")
+
+TERRAFORM_VERSION = "1.0.3"
+
+# Seconds each stand-in command, and each HTTP request, takes by default
+DEFAULT_LATENCY = {
+    "http": 0.05,
+    "aws": 0.3,
+    "gcloud": 0.2,
+    "ssh": 0.1,
+    "scp": 0.1,
+    "ssh-keygen": 0.05,
+    "terraform": 0.05,
+    "terraform init": 0.3,
+    "terraform apply": 1.0,
+    "terraform destroy": 1.0,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the CitC installers against local stand-ins")
+    parser.add_argument("--latency", action="append", default=[], metavar="NAME=SECONDS", help="Override the latency of a stand-in command, e.g. 'terraform apply=5' or 'http=0.5'")
+    parser.add_argument("--baseline", default=os.path.join(BENCH_DIR, "baseline.json"), help="File of baseline timings to compare against")
+    parser.add_argument("--update-baseline", action="store_true", help="Save these timings as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Fraction by which a phase may exceed its baseline")
+    parser.add_argument("--slack", type=float, default=0.5, help="Seconds by which a phase may exceed its baseline regardless of tolerance")
+    parser.add_argument("--keep", action="store_true", help="Keep the benchmark directory for inspection")
+    args = parser.parse_args()
+
+    latency = dict(DEFAULT_LATENCY)
+    for setting in args.latency:
+        name, _, seconds = setting.rpartition("=")
+        latency[name] = float(seconds)
+
+    bench = Bench(latency)
+    try:
+        results = bench.run()
+    finally:
+        if args.keep:
+            print("Benchmark files kept in {}".format(bench.root))
+        else:
+            shutil.rmtree(bench.root, ignore_errors=True)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    regressions = report(results, baseline, args.tolerance, args.slack)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({scenario: {phase: round(seconds, 2) for phase, seconds in phases.items()} for scenario, phases in results.items()}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("Saved baseline to {}".format(args.baseline))
+    elif regressions:
+        print("{} phases regressed".format(regressions))
+        sys.exit(1)
+
+
+class Bench(object):
+    """A scratch directory with stand-in commands, servers and fixtures for the installers"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.root = tempfile.mkdtemp(prefix="citc-bench-")
+        self.bin_dir = self.path("bin")
+        self.remote = self.path("remote")
+        self.home = self.path("home")
+        os.makedirs(os.path.join(self.home, ".ssh"))
+
+        for tool in ["terraform", "aws", "gcloud", "ssh", "scp", "ssh-keygen"]:
+            self.write_stub(os.path.join(self.bin_dir, tool), tool)
+
+        self.http_drops = {}
+        self.http_port = self.serve_http(self.make_http_root())
+        self.ssh_port = self.serve_ssh_banner()
+        self.git_repo = self.make_git_repo()
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def write_stub(self, path, tool):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write('#! /bin/sh\nexec "{}" "{}" {} "$@"\n'.format(sys.executable, os.path.join(BENCH_DIR, "stub.py"), tool))
+        os.chmod(path, 0o755)
+
+    def make_http_root(self):
+        """Lay out a Terraform release and a GitHub archive as the installers expect to find them"""
+        http_root = self.path("http")
+
+        release_dir = os.path.join(http_root, "releases", TERRAFORM_VERSION)
+        os.makedirs(release_dir)
+        stub_terraform = self.path("terraform-stub")
+        self.write_stub(stub_terraform, "terraform")
+        sums = []
+        for platform in ["linux_amd64", "darwin_amd64"]:
+            zip_name = "terraform_{}_{}.zip".format(TERRAFORM_VERSION, platform)
+            with zipfile.ZipFile(os.path.join(release_dir, zip_name), "w") as zip_file:
+                zip_file.write(stub_terraform, "terraform")
+            with open(os.path.join(release_dir, zip_name), "rb") as f:
+                sums.append("{}  {}\n".format(hashlib.sha256(f.read()).hexdigest(), zip_name))
+        with open(os.path.join(release_dir, "terraform_{}_SHA256SUMS".format(TERRAFORM_VERSION)), "w") as f:
+            f.writelines(sums)
+
+        archive_dir = os.path.join(http_root, "github", "clusterinthecloud", "terraform", "archive")
+        os.makedirs(archive_dir)
+        with tarfile.open(os.path.join(archive_dir, "master.tar.gz"), "w:gz") as tar:
+            for name, content in config_files("terraform-master/").items():
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+
+        return http_root
+
+    def make_git_repo(self):
+        work = self.path("terraform-work")
+        for name, content in config_files("").items():
+            os.makedirs(os.path.join(work, os.path.dirname(name)), exist_ok=True)
+            with open(os.path.join(work, name), "wb") as f:
+                f.write(content)
+        git = ["git", "-c", "user.name=bench", "-c", "user.email=bench@example.com", "-C", work]
+        subprocess.check_call(git + ["init", "-q", "-b", "master"])
+        subprocess.check_call(git + ["add", "."])
+        subprocess.check_call(git + ["commit", "-q", "-m", "Benchmark configuration"])
+        subprocess.check_call(["git", "clone", "-q", "--bare", work, self.path("terraform.git")])
+        return self.path("terraform.git")
+
+    def serve_http(self, directory):
+        latency = self.latency.get("http", 0)
+        drops = self.http_drops
+
+        class Handler(http.server.SimpleHTTPRequestHandler):
+            """Serve files with byte ranges, as HashiCorp's releases server does
+
+            While drops has a count above zero for a path, that many responses for it
+            are cut off half way through.
+            """
+
+            def do_GET(self):
+                time.sleep(latency)
+                path = self.translate_path(self.path)
+                if not os.path.isfile(path):
+                    super().do_GET()
+                    return
+                with open(path, "rb") as f:
+                    data = f.read()
+                modified = self.date_time_string(int(os.path.getmtime(path)))
+
+                body = data
+                match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+                if match and int(match.group(1)) < len(data) and self.headers.get("If-Range", modified) == modified:
+                    begin = int(match.group(1))
+                    end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+                    body = data[begin:end + 1]
+                    self.send_response(206)
+                    self.send_header("Content-Range", "bytes {}-{}/{}".format(begin, end, len(data)))
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Type", self.guess_type(path))
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("Last-Modified", modified)
+                self.send_header("Accept-Ranges", "bytes")
+                self.end_headers()
+
+                with drops_lock:
+                    drop = drops.get(self.path, 0) > 0
+                    if drop:
+                        drops[self.path] -= 1
+                try:
+                    self.wfile.write(body[:len(body) // 2] if drop else body)
+                except ConnectionError:
+                    # The download closed the connection early, as it does for a piece it already has
+                    pass
+                self.close_connection = True
+
+            def log_message(self, *args):
+                pass
+
+        drops_lock = threading.Lock()
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(Handler, directory=directory))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server.server_address[1]
+
+    def serve_ssh_banner(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(16)
+
+        def serve():
+            while True:
+                connection, _ = listener.accept()
+                connection.sendall(b"SSH-2.0-OpenSSH_bench\r\n")
+                connection.close()
+
+        threading.Thread(target=serve, daemon=True).start()
+        return listener.getsockname()[1]
+
+    def env(self, home):
+        env = dict(os.environ)
+        env.update({
+            "PATH": self.bin_dir + os.pathsep + env["PATH"],
+            "HOME": home,
+            "CITC_CACHE_DIR": self.path("cache"),
+            "CITC_GITHUB_URL": "http://127.0.0.1:{}/github".format(self.http_port),
+            "CITC_TERRAFORM_RELEASES_URL": "http://127.0.0.1:{}/releases".format(self.http_port),
+            "CITC_TERRAFORM_GIT_URL": self.git_repo,
+            "CITC_SSH_PORT": str(self.ssh_port),
+            "CITC_BENCH_REMOTE": self.remote,
+            "CITC_BENCH_LATENCY": json.dumps(self.latency),
+        })
+        env.pop("CLOUDSDK_CONFIG", None)
+        return env
+
+    def run_script(self, name, script, args, workspace, home=None):
+        """Run an installer script in workspace and return its wall time"""
+        os.makedirs(workspace, exist_ok=True)
+        log_file = os.path.join(workspace, "bench.log")
+        start = time.time()
+        with open(log_file, "w") as log:
+            returncode = subprocess.call([sys.executable, script] + args, cwd=workspace, env=self.env(home or self.home), stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+        elapsed = time.time() - start
+        if returncode != 0:
+            with open(log_file) as f:
+                print(f.read())
+            raise RuntimeError("{} failed with exit code {}".format(name, returncode))
+        return elapsed
+
+    def install_phases(self, name, script, args, workspace, home=None):
+        """Run an installer which supports --metrics-file and return its per-stage timings"""
+        metrics_file = os.path.join(workspace, "metrics.json")
+        total = self.run_script(name, script, args + ["--metrics-file", metrics_file], workspace, home)
+        with open(metrics_file) as f:
+            phases = {stage["stage"]: stage["wall_seconds"] for stage in json.load(f)["stages"]}
+        phases["total"] = total
+        return phases
+
+    def download_phases(self):
+        """Fetch a file of several pieces with citc_common.download and return the time each case took
+
+        The cases are connections dropping part way through pieces, and a download
+        interrupted after its first piece and then carried on from the .part.json
+        left behind. A wrong checksum must be rejected.
+        """
+        sys.path.insert(0, REPO_DIR)
+        import citc_common
+
+        piece_size = citc_common.DOWNLOAD_PIECE_SIZE
+        os.makedirs(self.path("http", "downloads"))
+        with open(self.path("http", "downloads", "pieces.bin"), "wb") as f:
+            f.write(os.urandom(piece_size * 5 // 2))
+        with open(self.path("http", "downloads", "pieces.bin"), "rb") as f:
+            expected = hashlib.sha256(f.read()).hexdigest()
+        url = "http://127.0.0.1:{}/downloads/pieces.bin".format(self.http_port)
+        dest = self.path("pieces.bin")
+        phases = {}
+
+        def download(**kwargs):
+            with contextlib.redirect_stdout(io.StringIO()):
+                return citc_common.download(url, dest, expected_sha256=expected, **kwargs)[1]
+
+        # Two pieces lose their connection half way and carry on from where they got to
+        self.http_drops["/downloads/pieces.bin"] = 2
+        start = time.time()
+        download()
+        phases["dropped"] = time.time() - start
+        if self.http_drops["/downloads/pieces.bin"]:
+            raise RuntimeError("The download did not go through the dropped connections")
+        os.remove(dest)
+
+        # Stop once the second piece has begun to arrive, which with one connection is
+        # only after the first has been recorded as done
+        class Interrupted(Exception):
+            pass
+
+        received = [0]
+
+        def interrupt(size):
+            received[0] += size
+            if received[0] > piece_size:
+                deadline = time.time() + 10
+                while not os.path.exists(dest + ".part.json") and time.time() < deadline:
+                    time.sleep(0.01)
+                raise Interrupted()
+
+        connections = citc_common.DOWNLOAD_CONNECTIONS
+        citc_common.DOWNLOAD_CONNECTIONS = 1
+        try:
+            download(progress=interrupt)
+        except Interrupted:
+            pass
+        finally:
+            citc_common.DOWNLOAD_CONNECTIONS = connections
+        with open(dest + ".part.json") as f:
+            if json.load(f)["done"] != [0]:
+                raise RuntimeError("The interrupted download did not record its first piece")
+
+        received = [0]
+        start = time.time()
+        download(progress=lambda size: received.__setitem__(0, received[0] + size))
+        phases["resumed"] = time.time() - start
+        if received[0] != piece_size * 3 // 2 or os.path.exists(dest + ".part.json"):
+            raise RuntimeError("The resumed download fetched {} bytes rather than those it was missing".format(received[0]))
+        os.remove(dest)
+
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                citc_common.download(url, dest, expected_sha256="0" * 64)
+        except RuntimeError:
+            pass
+        else:
+            raise RuntimeError("A download with the wrong checksum was accepted")
+        if any(os.path.exists(dest + suffix) for suffix in ("", ".part", ".part.json")):
+            raise RuntimeError("A download with the wrong checksum was left behind")
+
+        return phases
+
+    def run(self):
+        results = {}
+
+        install = os.path.join(REPO_DIR, "install-citc.py")
+        results["aws-install-cold"] = self.install_phases("aws-install-cold", install, ["aws", "--result-file", "result.json"], self.path("aws-cold"))
+        results["aws-install-warm"] = self.install_phases("aws-install-warm", install, ["aws", "--result-file", "result.json"], self.path("aws-warm"))
+
+        with open(self.path("aws-warm", "result.json")) as f:
+            cluster = json.load(f)
+        key = self.path("aws-warm", cluster["key"])
+        destroy_args = [cluster["csp"], cluster["ip"], key, "--yes"]
+        results["aws-destroy"] = {"total": self.run_script("aws-destroy", os.path.join(REPO_DIR, "destroy-citc.py"), destroy_args, self.path("aws-destroy"))}
+        results["download"] = self.download_phases()
+
+        if sys.version_info < (3, 7) or importlib.util.find_spec("petname") is None:
+            print("Skipping the Google installer benchmarks as they need Python 3.7+ and petname")
+            return results
+
+        # The Google scripts run in the home directory of their container
+        for workspace in ["google-install", "google-destroy"]:
+            os.makedirs(self.path(workspace, ".ssh"))
+
+        install_args = ["--project", "bench", "--zone", "europe-west2-c", "--key", "ssh-rsa AAAA bench", "--shape", "n1-standard-1", "--branch", "master"]
+        results["google-install"] = self.install_phases("google-install", os.path.join(GOOGLE_DIR, "install_citc.py"), install_args, self.path("google-install"), self.path("google-install"))
+
+        with open(self.path("google-install", "checkpoint_input.json")) as f:
+            name = json.load(f)["name"]
+        destroy_args = ["--host", "127.0.0.1", "--project", "bench", "--zone", "europe-west2-c", "--name", name]
+        results["google-destroy"] = {"total": self.run_script("google-destroy", os.path.join(GOOGLE_DIR, "destroy_citc.py"), destroy_args, self.path("google-destroy"), self.path("google-destroy"))}
+
+        return results
+
+
+def config_files(prefix):
+    """The files of a minimal CitC Terraform configuration"""
+    files = {
+        "LICENSE": b"Benchmark configuration\n",
+        "aws/main.tf": b'terraform {\n  required_providers {\n    aws = {\n      source = "hashicorp/aws"\n    }\n  }\n}\n',
+        "aws/terraform.tfvars.example": b'private_key_path = "~/.ssh/aws-key"\nadmin_public_keys = <<EOF\nEOF\n',
+        "google/main.tf": b'provider "google" {}\n',
+    }
+    return {prefix + name: content for name, content in files.items()}
+
+
+def report(results, baseline, tolerance, slack):
+    """Print the timings beside their baselines and return how many phases have regressed"""
+    regressions = 0
+    print("{:<18} {:<24} {:>9} {:>9}".format("SCENARIO", "PHASE", "SECONDS", "BASELINE"))
+    for scenario, phases in results.items():
+        for phase, seconds in phases.items():
+            expected = baseline.get(scenario, {}).get(phase)
+            status = ""
+            if expected is not None and seconds > expected * (1 + tolerance) + slack:
+                status = "REGRESSED"
+                regressions += 1
+            print("{:<18} {:<24} {:>9.2f} {:>9} {}".format(scenario, phase, seconds, "" if expected is None else "{:.2f}".format(expected), status).rstrip())
+    return regressions
+
+
+if __name__ == "__main__":
+    main()
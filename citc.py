@@ -0,0 +1,262 @@
+#! /usr/bin/env python
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import json
+import os
+import os.path
+import sys
+import time
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The script which carries out each command on each cloud provider. They are only
+# loaded once one is needed, so that --help, checking arguments and status are fast.
+BACKENDS = {
+    ("install", "aws"): os.path.join(DIR, "install-citc.py"),
+    ("destroy", "aws"): os.path.join(DIR, "destroy-citc.py"),
+    ("install", "google"): os.path.join(DIR, "docker", "google-base", "install_citc.py"),
+    ("destroy", "google"): os.path.join(DIR, "docker", "google-base", "destroy_citc.py"),
+}
+
+# The Terraform version the Google scripts are run with, as in docker/google-base/Dockerfile.
+# Their configuration is written for 0.12, so bundles for them must hold a 0.12 release.
+GOOGLE_TERRAFORM_VERSION = "0.12.21"
+GOOGLE_TERRAFORM_SERIES = "0.12."
+
+# Top-level directories of the CitC Terraform repo which hold a single provider's configuration
+PROVIDER_DIRS = ("aws", "google", "oracle")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage Cluster in the Cloud clusters")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    for command, description in [("install", "Create a cluster"), ("destroy", "Destroy a cluster")]:
+        command_parser = subparsers.add_parser(
+            command,
+            help=description,
+            description="{}. Any further arguments are passed to the cloud provider's {} script, see 'citc {} CSP --help'.".format(description, command, command),
+        )
+        command_parser.add_argument("csp", choices=["aws", "google"], help="Which cloud provider the cluster is in")
+        command_parser.add_argument("arguments", nargs=argparse.REMAINDER, help="Arguments for the {} script".format(command))
+        command_parser.set_defaults(func=run_backend)
+
+    bundle_parser = subparsers.add_parser("bundle", help="Work with offline install bundles")
+    bundle_subparsers = bundle_parser.add_subparsers(dest="bundle_command")
+    bundle_subparsers.required = True
+    export_parser = bundle_subparsers.add_parser(
+        "export",
+        help="Save everything an install downloads into one file",
+        description="Save the CitC Terraform configuration, the Terraform binary and the provider plugins into one file, "
+                    "for 'citc install CSP --bundle FILE' on a machine without access to GitHub, HashiCorp or the Terraform registry.",
+    )
+    export_parser.add_argument("csp", choices=["aws", "google"], help="Which cloud provider the bundle is for")
+    export_parser.add_argument("--terraform-repo", default="clusterinthecloud/terraform", help="CitC Terraform GitHub project repo to use")
+    export_parser.add_argument("--terraform-branch", default="master", help="CitC Terraform branch to use")
+    export_parser.add_argument("--terraform-version", help="Terraform version to include (default: the one the installer for CSP uses)")
+    export_parser.add_argument("--output", help="File to write (default: citc-bundle-CSP-BRANCH-VERSION.tar.gz)")
+    export_parser.set_defaults(func=bundle_export)
+
+    status_parser = subparsers.add_parser("status", help="List the clusters installed from some directories")
+    status_parser.add_argument("directories", nargs="*", default=["."], help="Directories the installers were run in (default: the current directory)")
+    status_parser.add_argument("--manifest", help="Also list the clusters of a fleet-citc.py manifest")
+    status_parser.add_argument("--workdir", default="citc-fleet", help="Directory holding the workspace for each cluster in the manifest")
+    status_parser.add_argument("--no-probe", help="Do not check whether the management nodes are up", action="store_true")
+    status_parser.add_argument("--timeout", type=float, default=1.0, help="Seconds to wait for the management nodes to answer")
+    status_parser.add_argument("--json", help="Print the clusters as JSON", action="store_true")
+    status_parser.set_defaults(func=status)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+def run_backend(args):
+    """Run the script for a command and cloud provider as if it had been run directly"""
+    script = BACKENDS[(args.command, args.csp)]
+    if args.csp == "google":
+        if sys.version_info < (3, 7):
+            print("The Google scripts need Python 3.7 or later")
+            exit(1)
+        arguments = args.arguments
+    else:
+        arguments = [args.csp] + args.arguments
+
+    import runpy
+
+    sys.argv = [script] + arguments
+    sys.path.insert(0, os.path.dirname(script))
+    runpy.run_path(script, run_name="__main__")
+
+
+def bundle_export(args):
+    """Write an offline bundle with the download code the installers use"""
+    if args.csp == "google" and args.terraform_version and not args.terraform_version.startswith(GOOGLE_TERRAFORM_SERIES):
+        print("The Google scripts need Terraform {}x, not {}".format(GOOGLE_TERRAFORM_SERIES, args.terraform_version))
+        exit(1)
+
+    from citc_common import TERRAFORM_VERSION, export_bundle
+
+    if not args.terraform_version:
+        args.terraform_version = GOOGLE_TERRAFORM_VERSION if args.csp == "google" else TERRAFORM_VERSION
+    if not args.output:
+        args.output = "citc-bundle-{}-{}-{}.tar.gz".format(args.csp, args.terraform_branch.replace("/", "_"), args.terraform_version)
+
+    export_bundle(args.csp, args.terraform_repo, args.terraform_branch, args.terraform_version, args.output)
+    print("Wrote {}".format(args.output))
+
+
+def status(args):
+    from citc_common import SSH_PORT, print_table
+
+    clusters = []
+    if args.manifest:
+        clusters.extend(find_fleet_clusters(args.manifest, args.workdir))
+        if args.directories == ["."]:
+            args.directories = []
+    for directory in args.directories:
+        clusters.extend(find_clusters(directory))
+
+    if not args.no_probe:
+        probes = probe_all(set(c["ip"] for c in clusters if c["ip"] and c["state"] == "created"), SSH_PORT, args.timeout)
+        for cluster in clusters:
+            cluster["ssh"] = probes.get(cluster["ip"])
+
+    if args.json:
+        print(json.dumps(clusters, indent=2, sort_keys=True))
+    elif not clusters:
+        print("No clusters found")
+    else:
+        print_table(
+            ["DIRECTORY", "CSP", "CLUSTER ID", "IP", "RESOURCES", "STATE", "SSH"],
+            [[c["directory"], c["csp"], c["cluster_id"], c["ip"], c["resources"], c["state"], describe_probe(c.get("ssh"))] for c in clusters],
+        )
+
+
+def find_fleet_clusters(manifest, workdir):
+    """Describe the clusters of a fleet-citc.py manifest from their workspaces"""
+    with open(manifest) as f:
+        names = [cluster["name"] for cluster in json.load(f)["clusters"]]
+
+    clusters = []
+    for name in names:
+        workspace = os.path.join(workdir, name)
+        found = find_clusters(workspace) if os.path.isdir(workspace) else []
+        if not found:
+            found = [{"directory": workspace, "csp": "", "cluster_id": "", "ip": "", "resources": 0, "state": "not created"}]
+        if os.path.exists(os.path.join(workspace, "destroyed.json")):
+            for cluster in found:
+                cluster["state"] = "destroyed"
+        clusters.extend(found)
+    return clusters
+
+
+def find_clusters(directory):
+    """Describe the clusters installed from a directory, using only what the installers left on disk
+
+    install-citc.py leaves a citc-terraform-<cluster_id> directory for each cluster,
+    or citc-terraform for one it did not finish. The Google installer leaves
+    checkpoint_input.json and a terraform checkout.
+    """
+    clusters = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not name.startswith("citc-terraform") or not os.path.isdir(path):
+            continue
+        for csp in PROVIDER_DIRS:
+            if os.path.isdir(os.path.join(path, csp)):
+                cluster = describe_state(os.path.join(path, csp, "terraform.tfstate"))
+                cluster.update(directory=path, csp=csp)
+                if name == "citc-terraform":
+                    cluster["state"] = "incomplete"
+                clusters.append(cluster)
+
+    inputs_file = os.path.join(directory, "checkpoint_input.json")
+    if os.path.exists(inputs_file):
+        with open(inputs_file) as f:
+            inputs = json.load(f)
+        cluster = describe_state(os.path.join(directory, "terraform", "terraform.tfstate"))
+        cluster.update(directory=directory, csp="google", cluster_id=inputs.get("name", ""))
+        clusters.append(cluster)
+
+    return clusters
+
+
+def describe_state(state_file):
+    """Summarise a cluster from its Terraform state file, if it has one"""
+    if not os.path.exists(state_file):
+        return {"cluster_id": "", "ip": "", "resources": 0, "state": "not created"}
+    with open(state_file) as f:
+        state = json.load(f)
+    outputs = dict((name, output["value"]) for name, output in state.get("outputs", {}).items())
+    resources = len(state.get("resources", []))
+    return {
+        "cluster_id": outputs.get("cluster_id", ""),
+        "ip": outputs.get("ManagementPublicIP", ""),
+        "resources": resources,
+        "state": "created" if resources or outputs else "destroyed",
+    }
+
+
+def probe_all(hosts, port, timeout):
+    """Probe the SSH port of every host at once, returning the results by host
+
+    Hosts which have not answered within timeout seconds are reported as unreachable.
+    """
+    import threading
+
+    results = {}
+
+    def run(host):
+        results[host] = probe(host, port, timeout)
+
+    threads = []
+    for host in hosts:
+        thread = threading.Thread(target=run, args=(host,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    deadline = time.time() + timeout
+    for thread in threads:
+        thread.join(max(0, deadline - time.time()))
+    return dict((host, results.get(host, {"reachable": False})) for host in hosts)
+
+
+def probe(host, port, timeout):
+    """Time how long a host takes to accept a connection on port and to send an SSH banner"""
+    import socket
+
+    result = {"reachable": False}
+    start = time.time()
+    try:
+        sock = socket.create_connection((host, port), timeout=timeout)
+    except (socket.error, socket.timeout):
+        return result
+    try:
+        result.update(reachable=True, connect_ms=round((time.time() - start) * 1000, 1))
+        sock.settimeout(max(0.01, timeout - (time.time() - start)))
+        banner = sock.recv(256)
+        if banner.startswith(b"SSH-"):
+            result.update(banner_ms=round((time.time() - start) * 1000, 1), banner=banner.splitlines()[0].decode("ascii", "replace"))
+    except (socket.error, socket.timeout):
+        pass
+    finally:
+        sock.close()
+    return result
+
+
+def describe_probe(result):
+    if result is None:
+        return ""
+    if "banner_ms" in result:
+        return "up ({:.0f} ms)".format(result["banner_ms"])
+    if result["reachable"]:
+        return "no SSH banner"
+    return "unreachable"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,681 @@
+"""Helpers shared by install-citc.py, destroy-citc.py, fleet-citc.py and citc.py
+
+Downloads, the per-user cache of Terraform binaries, configuration archives and
+provider plugins, running terraform init from it, and offline install bundles.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import os.path
+import random
+import re
+import shutil
+import stat
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from subprocess import call, check_call
+from zipfile import ZipFile
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+# The state bundle on the management node, and the list of its contents, as its first member
+BUNDLE_NAME = "citc-terraform.tar.gz"
+BUNDLE_MANIFEST = "MANIFEST.json"
+
+# The port the management nodes' SSH servers listen on
+SSH_PORT = int(os.environ.get("CITC_SSH_PORT", "22"))
+
+# Where Terraform releases are downloaded from, which can be pointed at a mirror
+TERRAFORM_RELEASES_URL = os.environ.get("CITC_TERRAFORM_RELEASES_URL", "https://releases.hashicorp.com/terraform")
+
+
+# Cached Terraform binaries which have not been used for this long are deleted
+TERRAFORM_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+
+
+def urllib_request():
+    """Return HTTPError, Request and urlopen
+
+    urllib is slow to import, so it is only loaded once something needs downloading.
+    """
+    try:
+        from urllib.error import HTTPError
+        from urllib.request import Request, urlopen
+    except ImportError:
+        from urllib2 import HTTPError, Request, urlopen
+    return HTTPError, Request, urlopen
+
+
+# Downloads from servers which accept byte ranges are split into pieces of this
+# many bytes, fetched over up to DOWNLOAD_CONNECTIONS connections at once
+DOWNLOAD_PIECE_SIZE = 4 * 1024 * 1024
+DOWNLOAD_CONNECTIONS = 4
+
+# How many times a dropped connection or server error is retried, and how long
+# a connection may stall for, in seconds
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_TIMEOUT = 60
+
+
+def download(url, dest, headers=None, expected_sha256=None, progress=None, consume=None):
+    """Download url to dest and return the response headers and the file's SHA256
+
+    If the server accepts byte ranges the file is fetched as several pieces at
+    once. The pieces which have arrived are recorded beside dest, so an interrupted
+    download carries on from them the next time, and a piece whose connection
+    drops is retried from where it got to. The file is checksummed in order as
+    the pieces arrive and checked against expected_sha256 if given. As with
+    urlopen, a conditional request for something unchanged raises HTTPError.
+
+    progress, if given, is called with the size of each chunk which arrives, and
+    with 0 before each connection is made. It may raise to abandon the download.
+    consume, if given, is called with a file object reading the contents. From a
+    server which does not accept byte ranges it reads them as they stream in,
+    before any checksum is checked, and otherwise it reads dest once it is
+    complete. Callers hold a cache_lock so that one process writes dest at a time.
+    """
+    HTTPError, Request, urlopen = urllib_request()
+    progress = progress or (lambda size: None)
+    part_file = dest + ".part"
+    started = time.time()
+
+    request = Request(url, headers=dict(headers or {}, Range="bytes=0-{}".format(DOWNLOAD_PIECE_SIZE - 1)))
+    response = urlopen_retrying(request, progress)
+    info = response.info()
+    content_range = re.match(r"bytes 0-\d+/(\d+)$", info.get("Content-Range") or "")
+    if response.getcode() == 206 and content_range:
+        etag = info.get("ETag")
+        validator = etag if etag and not etag.startswith("W/") else info.get("Last-Modified")
+        digest = download_pieces(url, response, int(content_range.group(1)), validator, part_file, progress)
+    else:
+        digest, consumed = download_whole(request, response, part_file, progress, consume)
+        if consumed:
+            consume = None
+
+    if expected_sha256 and digest.hexdigest() != expected_sha256:
+        os.remove(part_file)
+        if os.path.exists(part_file + ".json"):
+            os.remove(part_file + ".json")
+        raise RuntimeError("Checksum mismatch for {}: expected {}, got {}".format(url, expected_sha256, digest.hexdigest()))
+    os.rename(part_file, dest)
+    if os.path.exists(part_file + ".json"):
+        os.remove(part_file + ".json")
+
+    size = os.path.getsize(dest)
+    elapsed = max(time.time() - started, 0.001)
+    print("Downloaded {} ({:.1f} MB in {:.1f}s, {:.1f} MB/s)".format(url, size / 1e6, elapsed, size / 1e6 / elapsed))
+    if consume is not None:
+        with open(dest, "rb") as f:
+            consume(f)
+    return info, digest.hexdigest()
+
+
+def urlopen_retrying(request, progress):
+    """Open a request, retrying dropped connections and server errors with backoff"""
+    HTTPError, _, urlopen = urllib_request()
+    delays = backoff_delays(initial=1.0, maximum=10.0)
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        progress(0)
+        try:
+            return urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+        except EnvironmentError as e:
+            if (isinstance(e, HTTPError) and e.code < 500) or attempt == DOWNLOAD_RETRIES:
+                raise
+        time.sleep(next(delays))
+
+
+def download_whole(request, response, part_file, progress, consume):
+    """Stream a download from a server which does not accept byte ranges into part_file
+
+    Return its SHA256 and whether consume, if given, read it as it streamed in.
+    If the connection drops the download starts again from the beginning, and
+    the contents are left for the caller to consume from the finished file.
+    """
+    attempts = 0
+    delays = backoff_delays(initial=1.0, maximum=10.0)
+    while True:
+        try:
+            with open(part_file, "wb") as f:
+                reader = DownloadReader(response, f, progress)
+                if consume is not None and attempts == 0:
+                    try:
+                        consume(reader)
+                    except Exception:
+                        # A broken archive is the caller's to report, but a dropped connection is retried
+                        if reader.error is None:
+                            raise
+                        raise reader.error
+                for _ in iter(lambda: reader.read(1024 * 1024), b""):
+                    pass
+            response.close()
+            return reader.digest, consume is not None and attempts == 0
+        except EnvironmentError:
+            response.close()
+            attempts += 1
+            if attempts > DOWNLOAD_RETRIES:
+                raise
+            time.sleep(next(delays))
+            response = urlopen_retrying(request, progress)
+
+
+class DownloadReader(object):
+    """File-like reader of a response which saves and checksums everything read through it
+
+    A connection closed before Content-Length bytes arrived is raised as IOError,
+    and any error reading the response is kept in error.
+    """
+
+    def __init__(self, response, copy, progress):
+        self.response = response
+        self.copy = copy
+        self.progress = progress
+        self.digest = hashlib.sha256()
+        self.length = response.info().get("Content-Length")
+        self.position = 0
+        self.error = None
+
+    def read(self, size=-1):
+        try:
+            data = self.response.read(size)
+            if not data and size and self.length and self.position != int(self.length):
+                raise IOError("Connection closed after {} of {} bytes".format(self.position, self.length))
+        except EnvironmentError as e:
+            self.error = e
+            raise
+        self.progress(len(data))
+        self.digest.update(data)
+        self.copy.write(data)
+        self.position += len(data)
+        return data
+
+
+def download_pieces(url, first_response, size, validator, part_file, progress):
+    """Fetch the pieces of a download which are not already in part_file and return its SHA256
+
+    first_response is the open response for the first piece. Completed pieces are
+    listed in part_file.json along with what identifies the file they belong to.
+    """
+    pieces = [(begin, min(begin + DOWNLOAD_PIECE_SIZE, size)) for begin in range(0, size, DOWNLOAD_PIECE_SIZE)]
+    state = {"url": url, "size": size, "validator": validator, "done": []}
+    try:
+        with open(part_file + ".json") as f:
+            saved = json.load(f)
+        if validator and all(saved.get(key) == state[key] for key in ("url", "size", "validator")) and os.path.getsize(part_file) == size:
+            state["done"] = saved["done"]
+    except (EnvironmentError, ValueError):
+        pass
+    done = set(state["done"])
+    if done:
+        print("Resuming download of {}, {} of {} pieces already fetched".format(url, len(done), len(pieces)))
+    else:
+        with open(part_file, "wb") as f:
+            f.truncate(size)
+
+    pending = queue.Queue()
+    for index in range(len(pieces)):
+        if index not in done:
+            pending.put(index)
+    opened = {}
+    if 0 in done:
+        first_response.close()
+    else:
+        opened[0] = first_response
+    finished = queue.Queue()
+    failed = threading.Event()
+
+    def worker():
+        while not failed.is_set():
+            try:
+                index = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                begin, end = pieces[index]
+                if fetch_piece(url, begin, end, validator, part_file, opened.pop(index, None), failed, progress):
+                    finished.put((index, None))
+            except BaseException as e:
+                failed.set()
+                finished.put((index, e))
+                return
+
+    threads = [threading.Thread(target=worker) for _ in range(min(DOWNLOAD_CONNECTIONS, pending.qsize()))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # Checksum the pieces in order as soon as all those before them have arrived
+    digest = hashlib.sha256()
+    hashed = 0
+    with open(part_file, "rb") as part:
+        while True:
+            while hashed < len(pieces) and hashed in done:
+                part.seek(pieces[hashed][0])
+                digest.update(part.read(pieces[hashed][1] - pieces[hashed][0]))
+                hashed += 1
+            if hashed == len(pieces):
+                break
+            index, error = finished.get()
+            if error is not None:
+                for thread in threads:
+                    thread.join()
+                raise error
+            done.add(index)
+            state["done"] = sorted(done)
+            with open(part_file + ".json.tmp", "w") as f:
+                json.dump(state, f)
+            os.rename(part_file + ".json.tmp", part_file + ".json")
+    return digest
+
+
+def fetch_piece(url, begin, end, validator, part_file, response, failed, progress):
+    """Write bytes begin to end of url into part_file, reconnecting from where it got to if the connection drops
+
+    response, if given, is already open at begin. False is returned if the piece
+    was abandoned because another one failed.
+    """
+    HTTPError, Request, urlopen = urllib_request()
+    position = begin
+    attempts = 0
+    delays = backoff_delays(initial=1.0, maximum=10.0)
+    while position < end:
+        try:
+            if response is None:
+                headers = {"Range": "bytes={}-{}".format(position, end - 1)}
+                if validator:
+                    headers["If-Range"] = validator
+                progress(0)
+                response = urlopen(Request(url, headers=headers), timeout=DOWNLOAD_TIMEOUT)
+                if response.getcode() != 206:
+                    raise RuntimeError("{} changed while it was being downloaded".format(url))
+            with open(part_file, "r+b") as f:
+                f.seek(position)
+                while position < end:
+                    if failed.is_set():
+                        return False
+                    chunk = response.read(min(64 * 1024, end - position))
+                    if not chunk:
+                        raise IOError("Connection closed at byte {} of {}".format(position, url))
+                    f.write(chunk)
+                    position += len(chunk)
+                    progress(len(chunk))
+        except EnvironmentError as e:
+            attempts += 1
+            if (isinstance(e, HTTPError) and e.code < 500) or attempts > DOWNLOAD_RETRIES:
+                raise
+            time.sleep(next(delays))
+        finally:
+            if response is not None:
+                response.close()
+            response = None
+    return True
+
+
+def cached_terraform(version, progress=None):
+    """Return the path of a verified Terraform binary in the user cache, downloading it if needed
+
+    Binaries are keyed on version and platform so repeat installs do not need to
+    download them again. progress is passed on to download.
+    """
+
+    tf_platform = terraform_platform()
+    tf_cached = cache_path("terraform", "{v}_{p}".format(v=version, p=tf_platform), "terraform")
+    with cache_lock("terraform"):
+        if cached_file_valid(tf_cached):
+            print("Using cached Terraform binary {}".format(tf_cached))
+        else:
+            print("Downloading Terraform binary")
+            fetch_terraform(version, tf_platform, tf_cached, progress)
+        os.utime(os.path.dirname(tf_cached), None)
+        prune_cache(os.path.dirname(os.path.dirname(tf_cached)), TERRAFORM_CACHE_MAX_AGE)
+    return tf_cached
+
+
+def terraform_platform():
+    """Return the name HashiCorp uses for this platform in Terraform releases"""
+    if sys.platform.startswith("linux"):
+        return "linux_amd64"
+    elif sys.platform == "darwin":
+        return "darwin_amd64"
+    elif sys.platform == "win32":
+        raise NotImplementedError("Windows is not supported at the moment")
+    else:
+        raise NotImplementedError("Platform {platform} is not supported".format(platform=sys.platform))
+
+
+def install_terraform(tf_cached):
+    """Copy a cached Terraform binary into the current directory and return its path"""
+    if os.path.exists("terraform"):
+        os.remove("terraform")
+    shutil.copy(tf_cached, "terraform")
+    os.chmod("terraform", stat.S_IRWXU)
+    return "./terraform"
+
+
+def fetch_terraform(version, tf_platform, dest, progress=None):
+    """Download a Terraform release, check it against HashiCorp's SHA256SUMS and unpack it to dest"""
+    tf_base = "{url}/{v}/".format(url=TERRAFORM_RELEASES_URL, v=version)
+    zip_name = "terraform_{v}_{p}.zip".format(v=version, p=tf_platform)
+
+    _, _, urlopen = urllib_request()
+    sums = urlopen(tf_base + "terraform_{v}_SHA256SUMS".format(v=version), timeout=DOWNLOAD_TIMEOUT).read().decode()
+    expected = dict(reversed(line.split()) for line in sums.splitlines() if line.strip()).get(zip_name)
+    if not expected:
+        raise RuntimeError("No checksum published for {}".format(zip_name))
+
+    dest_dir = os.path.dirname(dest)
+    if os.path.exists(dest + ".sha256"):
+        os.remove(dest + ".sha256")
+    tf_zip = dest + ".zip"
+    download(tf_base + zip_name, tf_zip, expected_sha256=expected, progress=progress)
+    # Unpack beside the cache entry and move it into place so that concurrent
+    # installers never see a partly written binary
+    unpack_dir = tempfile.mkdtemp(dir=dest_dir)
+    try:
+        ZipFile(tf_zip).extract("terraform", unpack_dir)
+        os.chmod(os.path.join(unpack_dir, "terraform"), stat.S_IRWXU)
+        os.rename(os.path.join(unpack_dir, "terraform"), dest)
+    finally:
+        shutil.rmtree(unpack_dir, ignore_errors=True)
+        if os.path.exists(tf_zip):
+            os.remove(tf_zip)
+
+    with open(dest + ".sha256", "w") as f:
+        f.write(file_sha256(dest))
+
+
+# Where the CitC Terraform configuration is downloaded from, which can be pointed at a mirror
+GITHUB_URL = os.environ.get("CITC_GITHUB_URL", "https://github.com")
+
+# The Terraform version installs use
+TERRAFORM_VERSION = "1.0.3"
+
+# Cached source archives which have not been used for this long are deleted
+SOURCE_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+
+
+def fetch_source(repo, branch, csp, dest, progress=None):
+    """Extract the configuration for csp from the GitHub archive of a repo branch into dest
+
+    The archive is kept in the user cache and only downloaded again if its ETag or
+    Last-Modified have changed, so an unchanged branch costs a single request with
+    no body. A new download from GitHub, which does not serve byte ranges, is
+    extracted as it streams in rather than after being saved. progress is passed
+    on to download.
+    """
+    archive = cache_path("source", "{}_{}".format(repo.replace("/", "_"), branch.replace("/", "_")), "archive.tar.gz")
+    meta_file = archive + ".json"
+    with cache_lock("source"):
+        meta = {}
+        if cached_file_valid(archive):
+            with open(meta_file) as f:
+                meta = json.load(f)
+
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+        HTTPError, _, _ = urllib_request()
+        try:
+            info, sha256 = download("{url}/{repo}/archive/{branch}.tar.gz".format(url=GITHUB_URL, repo=repo, branch=branch), archive, headers,
+                                    progress=progress, consume=lambda f: extract_config(f, csp, dest))
+        except HTTPError as e:
+            if e.code != 304:
+                raise
+            print("Using cached {}".format(archive))
+            with open(archive, "rb") as f:
+                extract_config(f, csp, dest)
+        else:
+            with open(meta_file, "w") as f:
+                json.dump({"etag": info.get("ETag"), "last_modified": info.get("Last-Modified")}, f)
+            with open(archive + ".sha256", "w") as f:
+                f.write(sha256)
+
+        os.utime(os.path.dirname(archive), None)
+        prune_cache(os.path.dirname(os.path.dirname(archive)), SOURCE_CACHE_MAX_AGE)
+
+
+# Top-level directories of the CitC Terraform repo which hold a single provider's configuration
+PROVIDER_DIRS = ("aws", "google", "oracle")
+
+
+def extract_config(fileobj, csp, dest):
+    """Extract a CitC Terraform archive stream into dest, skipping other providers' configuration
+
+    The archive's top-level directory is stripped from the member names.
+    """
+    skip = [p for p in PROVIDER_DIRS if p != csp]
+    tar = tarfile.open(fileobj=fileobj, mode="r|gz")
+    for member in tar:
+        path = member.name.partition("/")[2]
+        if not path or path.split("/")[0] in skip:
+            continue
+        member.name = path
+        tar.extract(member, dest)
+    tar.close()
+
+
+@contextlib.contextmanager
+def cache_lock(name):
+    """Hold an exclusive lock on part of the user cache, shared with other installer processes"""
+    with open(cache_path(name + ".lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def cache_path(*parts):
+    """Return a path inside the per-user CitC cache, creating its parent directory"""
+    base = os.environ.get("CITC_CACHE_DIR")
+    if not base:
+        base = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "citc")
+    path = os.path.join(base, *parts)
+    makedirs(os.path.dirname(path))
+    return path
+
+
+def cached_file_valid(path):
+    """Check a cached file against the checksum recorded alongside it"""
+    try:
+        with open(path + ".sha256") as f:
+            expected = f.read().strip()
+    except IOError:
+        return False
+    return os.path.isfile(path) and file_sha256(path) == expected
+
+
+def prune_cache(directory, max_age):
+    """Remove entries in a cache directory which have not been used in max_age seconds"""
+    cutoff = time.time() - max_age
+    for entry in os.listdir(directory):
+        entry_path = os.path.join(directory, entry)
+        if os.path.getmtime(entry_path) < cutoff:
+            print("Removing stale cache entry {}".format(entry_path))
+            shutil.rmtree(entry_path, ignore_errors=True)
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def terraform_init(terraform, csp):
+    """Run terraform init for csp using the shared provider plugin cache
+
+    If every provider in the configuration's lock file is already in the cache
+    they are installed straight from disk without contacting the registry.
+    Terraform does not support concurrent use of a plugin cache, so runs are
+    serialised with a lock.
+    """
+    with cache_lock("plugins"):
+        plugin_dir = os.path.abspath(cache_path("plugins", ""))
+        env = dict(os.environ, TF_PLUGIN_CACHE_DIR=plugin_dir)
+
+        lock_file = os.path.join(csp, ".terraform.lock.hcl")
+        cached_lock = cache_path("locks", "{}-{}.hcl".format(csp, config_hash(csp)))
+        if not os.path.exists(lock_file) and os.path.exists(cached_lock):
+            shutil.copy(cached_lock, lock_file)
+
+        if os.path.exists(lock_file) and locked_providers_cached(lock_file, plugin_dir):
+            if call([terraform, "-chdir={}".format(csp), "init", "-plugin-dir={}".format(plugin_dir)], env=env) == 0:
+                return
+            print("Could not initialise from the plugin cache, falling back to the registry")
+        check_call([terraform, "-chdir={}".format(csp), "init"], env=env)
+        if os.path.exists(lock_file):
+            shutil.copy(lock_file, cached_lock)
+
+
+def config_hash(csp):
+    """Hash the Terraform files of a configuration, to key its lock file in the cache"""
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(csp)):
+        if name.endswith(".tf"):
+            with open(os.path.join(csp, name), "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def locked_providers_cached(lock_file, plugin_dir):
+    """Check whether every provider version pinned in a lock file is in the plugin cache"""
+    with open(lock_file) as f:
+        providers = re.findall(r'provider\s+"([^"]+)"\s*{\s*version\s*=\s*"([^"]+)"', f.read())
+    return bool(providers) and all(os.path.isdir(os.path.join(plugin_dir, source, version)) for source, version in providers)
+
+
+# Terraform's own default parallelism is 10. Going much higher than this risks
+# the cloud provider's API rate limits.
+MAX_PARALLELISM = 30
+
+
+def default_parallelism(csp):
+    """Allow Terraform to create or destroy every resource of csp's configuration at once, within limits"""
+    count = 0
+    for name in os.listdir(csp):
+        if name.endswith(".tf"):
+            with open(os.path.join(csp, name)) as f:
+                count += len(re.findall(r'^\s*resource\s+"', f.read(), re.MULTILINE))
+    return max(10, min(count, MAX_PARALLELISM))
+
+
+def backoff_delays(initial=0.1, maximum=1.0):
+    """Generate exponentially increasing delays, each jittered between half and all of its value"""
+    delay = initial
+    while True:
+        yield random.uniform(delay / 2, delay)
+        delay = min(delay * 2, maximum)
+
+
+# Offline bundles have the layout of the configuration built into the Google
+# image, plus the Terraform binary in bin and a manifest
+OFFLINE_BUNDLE_FORMAT = 1
+OFFLINE_BUNDLE_MANIFEST = "bundle.json"
+
+
+def export_bundle(csp, repo, branch, terraform_version, path):
+    """Write everything an install for csp downloads before Terraform applies into one gzipped tar at path
+
+    That is the configuration from the repo branch with its lock file, the Terraform
+    binary and the provider plugins, so that the install can run on a machine which
+    cannot reach GitHub, HashiCorp or the Terraform registry.
+    """
+    work = tempfile.mkdtemp()
+    try:
+        print("Downloading CitC Terraform configuration")
+        fetch_source(repo, branch, csp, os.path.join(work, "terraform"))
+        with open(os.path.join(work, "terraform.branch"), "w") as f:
+            f.write(branch + "\n")
+
+        terraform = os.path.join(work, "bin", "terraform")
+        makedirs(os.path.dirname(terraform))
+        shutil.copy(cached_terraform(terraform_version), terraform)
+        os.chmod(terraform, stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
+
+        print("Downloading provider plugins")
+        plugin_dir = os.path.join(work, "plugins")
+        makedirs(plugin_dir)
+        config_dir = os.path.join(work, "terraform", csp)
+        check_call([terraform, "init", "-backend=false"], cwd=config_dir, env=dict(os.environ, TF_PLUGIN_CACHE_DIR=plugin_dir))
+        shutil.rmtree(os.path.join(config_dir, ".terraform"))
+
+        manifest = {
+            "format": OFFLINE_BUNDLE_FORMAT,
+            "csp": csp,
+            "repo": repo,
+            "branch": branch,
+            "terraform_version": terraform_version,
+            "platform": terraform_platform(),
+        }
+        with open(os.path.join(work, OFFLINE_BUNDLE_MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+
+        with contextlib.closing(tarfile.open(path, "w:gz")) as tar:
+            for name in sorted(os.listdir(work)):
+                tar.add(os.path.join(work, name), name)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    return path
+
+
+def unpack_bundle(path):
+    """Unpack an offline bundle into the user cache and return its directory and manifest
+
+    Bundles are keyed on their checksum, so each one is only unpacked once.
+    """
+    bundle_dir = cache_path("bundles", file_sha256(path)[:16])
+    if not os.path.isdir(bundle_dir):
+        unpack_dir = tempfile.mkdtemp(dir=os.path.dirname(bundle_dir))
+        try:
+            with contextlib.closing(tarfile.open(path)) as tar:
+                tar.extractall(unpack_dir)
+            os.rename(unpack_dir, bundle_dir)
+        except OSError:
+            # Another installer unpacked the same bundle first
+            if not os.path.isdir(bundle_dir):
+                raise
+        finally:
+            shutil.rmtree(unpack_dir, ignore_errors=True)
+    os.utime(bundle_dir, None)
+
+    with open(os.path.join(bundle_dir, OFFLINE_BUNDLE_MANIFEST)) as f:
+        return bundle_dir, json.load(f)
+
+
+def copy_tree(source, dest):
+    """Copy the files under source which are not already in dest"""
+    for root, dirs, names in os.walk(source):
+        target = os.path.join(dest, os.path.relpath(root, source))
+        makedirs(target)
+        for name in names:
+            if not os.path.exists(os.path.join(target, name)):
+                shutil.copy2(os.path.join(root, name), os.path.join(target, name))
+
+
+def print_table(headings, rows):
+    widths = [max(len(str(cell)) for cell in column) for column in zip(headings, *rows)]
+    for row in [headings] + rows:
+        print("  ".join(str(cell).ljust(width) for cell, width in zip(row, widths)).rstrip())
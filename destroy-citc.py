@@ -3,15 +3,20 @@
 from __future__ import print_function, unicode_literals
 
 import argparse
+import contextlib
+import json
 import os
 import os.path
+import shutil
 import stat
 import tarfile
-from subprocess import check_call, CalledProcessError
-try:
-    from urllib.request import urlretrieve
-except ImportError:
-    from urllib import urlretrieve
+import tempfile
+import threading
+from subprocess import call, check_call, CalledProcessError, PIPE, Popen
+
+from citc_common import (
+    BUNDLE_MANIFEST, BUNDLE_NAME, MAX_PARALLELISM, SSH_PORT, cached_terraform, default_parallelism, install_terraform, terraform_init,
+)
 
 try:
     # Python 2/3 compatibility
@@ -26,44 +31,124 @@ def main():
     parser.add_argument("ip", help="The IP address of the cluster's management node")
     parser.add_argument("key", help="Path of the SSH key from cluster creation")
     parser.add_argument("--dry-run", help="Perform a dry run", action="store_true")
+    parser.add_argument("--parallelism", type=int, help="How many resources Terraform destroys at once (default: one per resource in the configuration, from 10 to {})".format(MAX_PARALLELISM))
+    parser.add_argument("--yes", help="Do not ask for confirmation", action="store_true")
     args = parser.parse_args()
 
     # Check that the user really meant it
-    if not args.dry_run:
+    if not args.dry_run and not args.yes:
         proceed = input("Are you sure you want to destroy the cluster at {}? [y/N]: ".format(args.ip))
         if proceed.lower() != "y":
             exit(1)
 
     # Download the Terraform configuration from the cluster
-    tf_zip_filename = "citc-terraform.tar.gz"
-    print("Downloading the Terraform configuration from {}".format(args.ip))
-    check_call(["scp", "-i", args.key, "-o", "IdentitiesOnly=yes", "citc@{}:{}".format(args.ip, tf_zip_filename), "."])
-    tf_tar = tarfile.open(tf_zip_filename)
-    dir_name = tf_tar.getnames()[0]
-    tf_tar.extractall()
-
-    # Shut down any running compute nodes and delete associated DNS entries
-    if not args.dry_run:
-        try:
-            print("Connecting to the cluster to destroy lingering compute nodes...")
-            check_call(["ssh", "-i", args.key, "-o", "IdentitiesOnly=yes", "citc@{}".format(args.ip), "/usr/local/bin/kill_all_nodes --force"])
-        except CalledProcessError:
-            print("/usr/local/bin/kill_all_nodes failed to run. You may have lingering compute nodes. You must kill these manually.")
+    session = SSHSession("citc", args.ip, args.key)
+    try:
+        print("Downloading the Terraform configuration from {}".format(args.ip))
+        dir_name = download_bundle(session)
 
-    os.chdir(dir_name)
+        # Shut down the compute nodes while Terraform is made ready to destroy the rest
+        killer = None
+        if not args.dry_run:
+            killer = threading.Thread(target=kill_all_nodes, args=(session,))
+            killer.start()
+        try:
+            os.chdir(dir_name)
 
-    os.chmod("terraform", stat.S_IRWXU)
-    check_call(["./terraform", "-chdir={}".format(args.csp), "init"])
+            terraform = bundle_terraform()
+            terraform_init(terraform, args.csp)
+        finally:
+            if killer is not None:
+                killer.join()
+    finally:
+        session.close()
 
     if not args.dry_run:
+        parallelism = args.parallelism or default_parallelism(args.csp)
         try:
             print("Destroying cluster...")
-            check_call(["./terraform", "-chdir={}".format(args.csp), "apply", "-destroy", "-auto-approve"])
+            check_call([terraform, "-chdir={}".format(args.csp), "apply", "-destroy", "-auto-approve", "-parallelism={}".format(parallelism)])
         except CalledProcessError:
             print("Terraform destroy failed. Try again with:")
             print("  cd {}".format(dir_name))
-            print("  ./terraform -chdir={} apply -destroy ".format(args.csp))
+            print("  {} -chdir={} apply -destroy ".format(terraform, args.csp))
             print("You may need to manually clean up any remaining running instances or DNS entries")
+            exit(1)
+
+
+def download_bundle(session):
+    """Extract the state bundle on the management node as it arrives and return the directory it made
+
+    Nothing is staged on the local disk but the extracted files.
+    """
+    download = session.stream("cat {}".format(BUNDLE_NAME))
+    try:
+        with contextlib.closing(tarfile.open(fileobj=download.stdout, mode="r|gz")) as tf_tar:
+            tf_tar.extractall()
+            dir_name = tf_tar.getnames()[0].split("/")[0]
+    finally:
+        # A failed download explains a broken archive better than tarfile can
+        download.stdout.close()
+        if download.wait() != 0:
+            raise CalledProcessError(download.returncode, "ssh cat {}".format(BUNDLE_NAME))
+    return dir_name
+
+
+def kill_all_nodes(session):
+    """Shut down any running compute nodes and delete associated DNS entries"""
+    try:
+        print("Connecting to the cluster to destroy lingering compute nodes...")
+        session.run("/usr/local/bin/kill_all_nodes --force")
+    except CalledProcessError:
+        print("/usr/local/bin/kill_all_nodes failed to run. You may have lingering compute nodes. You must kill these manually.")
+
+
+class SSHSession(object):
+    """Runs ssh commands on a host over one multiplexed connection
+
+    The first command opens an OpenSSH control master which later commands reuse,
+    so only one key exchange and authentication is needed for the whole session.
+    """
+
+    def __init__(self, user, host, key):
+        self.target = "{}@{}".format(user, host)
+        self.control_dir = tempfile.mkdtemp(prefix="citc-ssh-")
+        self.options = [
+            "-p", str(SSH_PORT),
+            "-i", os.path.abspath(key),
+            "-o", "IdentitiesOnly=yes",
+            "-o", "ControlMaster=auto",
+            "-o", "ControlPath={}".format(os.path.join(self.control_dir, "%r@%h:%p")),
+            "-o", "ControlPersist=60",
+        ]
+
+    def run(self, command):
+        check_call(["ssh"] + self.options + [self.target, command])
+
+    def stream(self, command):
+        """Start a command on the host and return its Popen, with the command's output on a pipe"""
+        return Popen(["ssh"] + self.options + [self.target, command], stdout=PIPE)
+
+    def close(self):
+        """Shut down the control master, if one was started"""
+        with open(os.devnull, "w") as devnull:
+            call(["ssh", "-O", "exit"] + self.options + [self.target], stdout=devnull, stderr=devnull)
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+
+
+def bundle_terraform():
+    """Return the path of a Terraform binary for the bundle extracted in the current directory
+
+    Bundles name the Terraform version in their manifest rather than include the
+    binary, so it is taken from the user cache shared with install-citc.py. Bundles
+    made by older versions of install-citc.py include the binary.
+    """
+    if not os.path.exists(BUNDLE_MANIFEST):
+        os.chmod("terraform", stat.S_IRWXU)
+        return "./terraform"
+    with open(BUNDLE_MANIFEST) as f:
+        version = json.load(f)["terraform_version"]
+    return install_terraform(cached_terraform(version))
 
 
 if __name__ == "__main__":
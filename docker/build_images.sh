@@ -8,8 +8,11 @@ else
 	DOCKER=docker
 fi
 
+# The CitC Terraform branch built into the images
+CITC_TERRAFORM_BRANCH=${CITC_TERRAFORM_BRANCH:-master}
+
 cd google-base
-$DOCKER build -t clusterinthecloud/google-base:latest .
+$DOCKER build --build-arg CITC_TERRAFORM_BRANCH="$CITC_TERRAFORM_BRANCH" -t clusterinthecloud/google-base:latest .
 
 cd ../google-install
 $DOCKER build -t clusterinthecloud/google-install:latest .
@@ -1,13 +1,28 @@
 
 import argparse
+import concurrent.futures
 import sys
 import json
 import os
 import shlex
 import subprocess
 
+import gcloud_config
+from gcloud_config import (current_stage, default_parallelism,
+                           gcloud_active_account, gcloud_property,
+                           max_parallelism, run_command, run_pipeline,
+                           stage_print)
+
 default_zone = "europe-west2-c"
 
+# Use the provider plugins built into the image, if it has them, so that
+# 'terraform init' only downloads those of other versions
+baked_dir = os.environ.get("CITC_BAKED_DIR", "/opt/citc")
+baked_plugins = os.path.join(baked_dir, "plugins")
+
+if os.path.isdir(baked_plugins):
+    os.environ.setdefault("TF_PLUGIN_CACHE_DIR", baked_plugins)
+
 parser = argparse.ArgumentParser()
 
 parser.add_argument("--host",
@@ -20,6 +35,10 @@ parser.add_argument("--project", help="Set the project in which the cluster "
 parser.add_argument("--name", help="The name of the cluster")
 parser.add_argument("--dry-run",
                     help="Perform a dry run", action="store_true")
+parser.add_argument("--parallelism", type=int,
+                    help=f"How many resources terraform destroys at once "
+                         f"(default one per resource in the configuration, "
+                         f"from 10 to {max_parallelism})")
 
 parser.add_argument("--json", help="Provide a JSON file containing input "
                                    "parameters")
@@ -31,42 +50,78 @@ if args.dry_run:
 else:
     dry = False
 
-last_stage = None
+gcloud_config.dry = dry
+
+# Images are deleted with this many to a gcloud command, with up to
+# image_delete_workers of the commands running at the same time
+image_batch_size = 10
+image_delete_workers = 4
+
+checkpoint_dir = os.getcwd()
 
-def has_completed(stage):
-    """Has the stage 'stage' completed yet? Returns True if it has, or else
-       False if it hasn't. Checking if 'stage' has completed implies that
-       any previous stage must have completed.
+def checkpoint_filename(stage):
+    return os.path.join(checkpoint_dir,
+                        f'checkpoint_{stage.replace(" ", "_")}.txt')
+
+def checkpoint_exists(stage):
+    """Has the stage 'stage' completed in a previous run?"""
+    return os.path.exists(checkpoint_filename(stage))
+
+def write_checkpoint(stage):
+    """Record that the stage 'stage' has completed"""
+    with open(checkpoint_filename(stage), "w") as FILE:
+        FILE.write("completed\n")
+
+def run_stages(stages):
+    """Run the stages in the dictionary 'stages' as gcloud_config.run_stages
+       does. Stages which completed in a previous run are skipped, and a
+       checkpoint is written as each stage completes.
     """
-    global last_stage
+    gcloud_config.run_stages(stages, checkpoint_exists,
+                             lambda stage, timing: write_checkpoint(stage))
 
-    filename = f'checkpoint_{stage.replace(" ", "_")}.txt'
+def cluster_inputs():
+    """Return the name and project of the cluster, as recorded by the
+       installer in the downloaded checkpoint_input.json
+    """
+    if dry:
+        return "missing_lemur", "my_project"
 
-    if os.path.exists(filename):
-        return True
+    with open(os.path.join(checkpoint_dir, "checkpoint_input.json")) as FILE:
+        data = json.load(FILE)
 
-    if last_stage:
-        last_filename = f'checkpoint_{last_stage.replace(" ","_")}.txt'
-        with open(last_filename, "w") as FILE:
-            FILE.write("completed\n")
+    return str(data["name"]), str(data["project"])
 
-    last_stage = stage
-    return False
+def delete_images(family):
+    """Delete every image in the image family 'family', in batches of
+       image_batch_size of which up to image_delete_workers are deleted
+       at the same time
+    """
+    list_images = f"gcloud compute images list --format \"value(name)\" " \
+                  f"--filter \"family={family}\""
 
-def run_command(cmd):
-    """Run the passed shell command"""
     if dry:
-        print(f"[DRY-RUN] {cmd}")
+        stage_print(f"[DRY-RUN] {list_images}")
         return
 
-    print(f"[EXECUTE] {cmd}")
+    stage_print(f"[EXECUTE] {list_images}")
+    p = subprocess.run(shlex.split(list_images), capture_output=True)
+
+    if p.returncode != 0:
+        raise RuntimeError(p.stderr.decode(errors="replace").strip())
+
+    images = p.stdout.decode().split()
+    batches = [images[i:i + image_batch_size]
+               for i in range(0, len(images), image_batch_size)]
+    stage = current_stage.name
 
-    try:
-        args = shlex.split(cmd)
-        subprocess.run(args).check_returncode()
-    except Exception as e:
-        print(f"[ERROR] {e}")
-        sys.exit(-1)
+    def delete_batch(batch):
+        current_stage.name = stage
+        run_command("gcloud compute images delete -q " + " ".join(batch))
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max(1, min(image_delete_workers, len(batches)))) as pool:
+        list(pool.map(delete_batch, batches))
 
 def run_everything(args):
     hostname = None
@@ -115,12 +170,8 @@ def run_everything(args):
         cluster_name = input("What is the name of the CitC cluster? ")
 
     if "CLOUDSDK_CONFIG" in os.environ:
-        project = subprocess.run(["gcloud", "config", "get-value", "core/project"], capture_output=True).stdout.decode().strip()
-        if project == "(unset)":
-            project = None
-        zone = subprocess.run(["gcloud", "config", "get-value", "compute/zone"], capture_output=True).stdout.decode().strip()
-        if zone == "(unset)":
-            zone = None
+        project = gcloud_property("core", "project")
+        zone = gcloud_property("compute", "zone")
 
     while not project:
         project = input("Which google project was the cluster "
@@ -139,69 +190,76 @@ def run_everything(args):
     if dry:
         print("*** DRY RUN ***\n\n")
 
-    if not has_completed("gcloud_set_project"):
-        run_command(f"gcloud config set project {project}")
-
-    if not subprocess.run(["gcloud", "auth", "list", "--filter=status:ACTIVE", "--format=value(account)"], capture_output=True).stdout.decode().strip():
-        if not has_completed("gcloud_login"):
-            run_command("gcloud auth login")
-
-    if not has_completed("download_terraform"):
-        scp_options = f"--strict-host-key-checking=no --quiet --zone={zone}"
+    if not gcloud_active_account():
+        # Logging in is interactive, so happens before any other stage
+        if not checkpoint_exists("gcloud_login"):
+            run_command("gcloud auth login", interactive=True)
+            write_checkpoint("gcloud_login")
 
+    def gcloud_set_project():
         run_command(f"gcloud config set project {project}")
-        run_command(f"gcloud compute scp {scp_options} "
-                    f"provisioner@mgmt-{cluster_name}:terraform.tgz "
-                    f"./terraform.tgz")
 
-    if not has_completed("untar_files"):
-        run_command("tar -zxvf terraform.tgz")
-
-    if dry:
-        cluster_name = "missing_lemur"
-        project = "my_project"
-    else:
-        with open("checkpoint_input.json") as FILE:
-            data = json.load(FILE)
+    def download_terraform():
+        # The archive is unpacked as it arrives, without a local copy
+        ssh_options = f"--strict-host-key-checking=no --quiet --zone={zone}"
 
-        cluster_name = str(data["name"])
-        project = str(data["project"])
+        run_pipeline(f"gcloud compute ssh {ssh_options} "
+                     f"provisioner@mgmt-{cluster_name} "
+                     f"--command 'cat terraform.tgz'",
+                     "tar -zxv")
 
-    print(f"Destroying the cluster called {cluster_name} in project {project}")
+        name, project_name = cluster_inputs()
+        stage_print(f"Destroying the cluster called {name} in "
+                    f"project {project_name}")
 
-    if not has_completed("gcloud_enable_services"):
+    def gcloud_enable_services():
         run_command(f"gcloud services enable compute.googleapis.com "
                                         f"iam.googleapis.com "
                                         f"cloudresourcemanager.googleapis.com "
                                         f"file.googleapis.com")
 
-    if not has_completed("terraform_destroy"):
-        if not dry:
-            os.chdir("terraform")
-            print(os.getcwd())
+    def terraform_destroy():
+        # Run in the configuration's directory without changing that of
+        # the other stages running at the same time
+        terraform_dir = os.path.join(checkpoint_dir, "terraform")
+        parallelism = args.parallelism or default_parallelism(
+            os.path.join(terraform_dir, "google"))
 
-        run_command("terraform init google")
-        run_command("terraform destroy -auto-approve google")
+        run_command("terraform init google", cwd=terraform_dir)
+        run_command(f"terraform destroy -auto-approve "
+                    f"-parallelism={parallelism} google", cwd=terraform_dir)
 
-    if not has_completed("remove_service_account"):
+    def remove_service_account():
+        cluster_name, project = cluster_inputs()
         citc_name = f"citc-admin-{cluster_name}"
         run_command(f"gcloud iam service-accounts delete --quiet "
                     f"{citc_name}@{project}.iam.gserviceaccount.com")
 
-    if not has_completed("remove_images"):
-        citc_family_name = f"citc-slurm-compute-{cluster_name}"
-        get_images = f"gcloud compute images list --format \"table[no-heading](name)\" --filter \"family={citc_family_name}\""
-                
-        args = shlex.split(get_images)
-        p1 = subprocess.Popen(args, stdout=subprocess.PIPE)    
-        delete_images = f"xargs gcloud compute images delete -q" 
-        args = shlex.split(delete_images)
-        p2 = subprocess.Popen(args, stdin=p1.stdout, stdout=subprocess.PIPE)
-        p1.stdout.close()
-        print(f"[EXECUTE] {get_images} | {delete_images}")
-        output = p2.communicate()[0]
-            
-    has_completed("everything")
+    def remove_images():
+        cluster_name, project = cluster_inputs()
+        delete_images(f"citc-slurm-compute-{cluster_name}")
+
+    ####
+    #### The images are not managed by terraform, so are deleted while
+    #### terraform destroys the cluster. The service account is removed
+    #### last, as terraform uses its credentials.
+    ####
+
+    run_stages({
+        "gcloud_set_project": ([], gcloud_set_project),
+        "download_terraform": (["gcloud_set_project"], download_terraform),
+        "gcloud_enable_services": (["gcloud_set_project"],
+                                   gcloud_enable_services),
+        "terraform_destroy": (["download_terraform",
+                               "gcloud_enable_services"],
+                              terraform_destroy),
+        "remove_images": (["download_terraform", "gcloud_enable_services"],
+                          remove_images),
+        "remove_service_account": (["terraform_destroy"],
+                                   remove_service_account),
+    })
+
+    write_checkpoint("everything")
 
     print("\n\nYour Cluster-in-the-Cloud has now been deleted :-(\n")
 
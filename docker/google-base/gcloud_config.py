@@ -0,0 +1,275 @@
+"""Reading gcloud's configuration and credentials without running gcloud,
+and running the stages of a command, shared by install_citc.py and
+destroy_citc.py"""
+import concurrent.futures
+import configparser
+import glob
+import os
+import pathlib
+import re
+import resource
+import shlex
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+probe_ttl = 5 * 60
+max_parallelism = 30
+
+# Set by the scripts from their --dry-run option
+dry = False
+
+current_stage = threading.local()
+print_lock = threading.Lock()
+
+def citc_cache_dir():
+    """Return the per-user cache shared with the AWS installer"""
+    return os.environ.get("CITC_CACHE_DIR") or os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+        "citc")
+
+def gcloud_config_dir():
+    return os.environ.get("CLOUDSDK_CONFIG") or \
+        os.path.expanduser("~/.config/gcloud")
+
+def gcloud_property(section, name):
+    """Return the gcloud property 'section/name' as 'gcloud config
+       get-value' would, or None if it is unset. The active configuration
+       is read straight from its file, and gcloud is only run if that fails.
+    """
+    value = os.environ.get(f"CLOUDSDK_{section}_{name}".upper())
+
+    if value:
+        return value
+
+    config_dir = gcloud_config_dir()
+    config_name = os.environ.get("CLOUDSDK_ACTIVE_CONFIG_NAME")
+
+    try:
+        if not config_name:
+            with open(os.path.join(config_dir, "active_config")) as FILE:
+                config_name = FILE.read().strip()
+    except OSError:
+        config_name = "default"
+
+    properties = configparser.ConfigParser(interpolation=None)
+
+    try:
+        properties.read(os.path.join(config_dir, "configurations",
+                                     f"config_{config_name or 'default'}"))
+    except configparser.Error:
+        value = subprocess.run(["gcloud", "config", "get-value",
+                                f"{section}/{name}"],
+                               capture_output=True).stdout.decode().strip()
+        return None if value in ("", "(unset)") else value
+
+    return properties.get(section, name, fallback=None) or None
+
+def gcloud_active_account():
+    """Return the account gcloud is logged in as, or None. An account
+       with credentials in gcloud's credential store is found without
+       running gcloud. Otherwise 'gcloud auth list' decides, and an
+       account it finds is remembered for probe_ttl seconds.
+    """
+    account = gcloud_property("core", "account")
+    config_dir = gcloud_config_dir()
+
+    if account:
+        if os.path.isdir(os.path.join(config_dir, "legacy_credentials",
+                                      account)):
+            return account
+
+        try:
+            db = sqlite3.connect(pathlib.Path(os.path.abspath(os.path.join(
+                config_dir, "credentials.db"))).as_uri() + "?mode=ro",
+                uri=True)
+
+            try:
+                if db.execute("SELECT 1 FROM credentials WHERE account_id = ?",
+                              (account,)).fetchone():
+                    return account
+            finally:
+                db.close()
+        except sqlite3.Error:
+            pass
+
+    probe_file = os.path.join(
+        citc_cache_dir(), "probes",
+        "gcloud-" + re.sub(r"[^A-Za-z0-9_.-]", "_", config_dir))
+
+    try:
+        if time.time() - os.path.getmtime(probe_file) < probe_ttl:
+            with open(probe_file) as FILE:
+                return FILE.read().strip()
+    except OSError:
+        pass
+
+    account = subprocess.run(["gcloud", "auth", "list",
+                              "--filter=status:ACTIVE",
+                              "--format=value(account)"],
+                             capture_output=True).stdout.decode().strip()
+
+    if account:
+        os.makedirs(os.path.dirname(probe_file), exist_ok=True)
+
+        with open(probe_file, "w") as FILE:
+            FILE.write(account + "\n")
+
+    return account or None
+
+def child_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def run_stages(stages, skip, completed):
+    """Run the stages in the dictionary 'stages', which maps each stage
+       name to a tuple of the names of the stages it depends on and the
+       function that runs it. A stage is started as soon as all of its
+       dependencies have completed, so independent stages run at the same
+       time. Dependencies not in 'stages' must have been run by an earlier
+       call.
+
+       Once its dependencies are done, a stage for which skip(stage) is
+       true is not run. completed(stage, timing) is called as each stage
+       that was run completes, with the wall clock and subprocess time it
+       took. If any stage fails, the stages already running are allowed to
+       finish before exiting.
+    """
+    done = set()
+    running = {}
+    failed = False
+
+    def run_stage(stage, func):
+        current_stage.name = stage
+        started = (time.time(), child_cpu_time())
+        func()
+        return started
+
+    with concurrent.futures.ThreadPoolExecutor(len(stages)) as pool:
+        while True:
+            while not failed:
+                ready = [stage for stage, (depends, func) in stages.items()
+                         if stage not in done and stage not in running.values()
+                         and all(d in done or d not in stages for d in depends)]
+
+                if not ready:
+                    break
+
+                for stage in ready:
+                    if skip(stage):
+                        done.add(stage)
+                    else:
+                        running[pool.submit(run_stage, stage,
+                                            stages[stage][1])] = stage
+
+            if not running:
+                break
+
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in finished:
+                stage = running.pop(future)
+
+                try:
+                    wall, cpu = future.result()
+                except BaseException as e:
+                    if not isinstance(e, SystemExit):
+                        print(f"[ERROR] [{stage}] {e}")
+                    failed = True
+                    continue
+
+                done.add(stage)
+                completed(stage, {"stage": stage,
+                                  "wall_seconds": time.time() - wall,
+                                  "subprocess_seconds":
+                                      child_cpu_time() - cpu})
+
+    if failed:
+        sys.exit(-1)
+
+def stage_print(message):
+    """Print 'message', prefixed by the name of the stage printing it"""
+    stage = getattr(current_stage, "name", None)
+
+    with print_lock:
+        for line in message.splitlines() or [""]:
+            print(f"[{stage}] {line}" if stage else line, flush=True)
+
+def run_command(cmd, interactive=False, cwd=None):
+    """Run the passed shell command, in the directory 'cwd' if given. Its
+       output is prefixed with the name of the stage running it, as stages
+       may run at the same time, unless it is 'interactive' and so needs
+       the terminal.
+    """
+    if dry:
+        stage_print(f"[DRY-RUN] {cmd}")
+        return
+
+    stage_print(f"[EXECUTE] {cmd}")
+
+    try:
+        args = shlex.split(cmd)
+
+        if interactive:
+            subprocess.run(args, cwd=cwd).check_returncode()
+            return
+
+        p = subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, cwd=cwd)
+
+        for line in p.stdout:
+            stage_print(line.decode(errors="replace").rstrip("\n"))
+
+        if p.wait() != 0:
+            raise subprocess.CalledProcessError(p.returncode, args)
+    except Exception as e:
+        stage_print(f"[ERROR] {e}")
+        sys.exit(-1)
+
+def run_pipeline(producer, consumer):
+    """Run the passed shell commands with the output of 'producer' piped
+       straight into 'consumer', so that nothing is staged on disk. The
+       output of 'consumer' is prefixed as by run_command.
+    """
+    if dry:
+        stage_print(f"[DRY-RUN] {producer} | {consumer}")
+        return
+
+    stage_print(f"[EXECUTE] {producer} | {consumer}")
+
+    try:
+        first = subprocess.Popen(shlex.split(producer),
+                                 stdin=subprocess.DEVNULL,
+                                 stdout=subprocess.PIPE)
+        second = subprocess.Popen(shlex.split(consumer), stdin=first.stdout,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT)
+        first.stdout.close()
+
+        for line in second.stdout:
+            stage_print(line.decode(errors="replace").rstrip("\n"))
+
+        for p, cmd in ((first, producer), (second, consumer)):
+            if p.wait() != 0:
+                raise subprocess.CalledProcessError(p.returncode, cmd)
+    except Exception as e:
+        stage_print(f"[ERROR] {e}")
+        sys.exit(-1)
+
+def default_parallelism(config_dir):
+    """Allow terraform to create or destroy every resource of the
+       configuration in 'config_dir' at once. Its own default is 10, and
+       going above max_parallelism risks the Google API rate limits.
+    """
+    count = 0
+
+    for filename in glob.glob(os.path.join(config_dir, "*.tf")):
+        with open(filename) as FILE:
+            count += len(re.findall(r'^\s*resource\s+"', FILE.read(),
+                                    re.MULTILINE))
+
+    return max(10, min(count, max_parallelism))
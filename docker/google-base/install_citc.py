@@ -1,15 +1,45 @@
 
 import argparse
+import glob
+import hashlib
 import sys
-import petname
 import json
 import os
+import random
 import shlex
+import shutil
+import socket
 import subprocess
+import tarfile
+import tempfile
+import time
+
+import gcloud_config
+from gcloud_config import (citc_cache_dir, default_parallelism,
+                           gcloud_active_account, gcloud_property,
+                           max_parallelism, run_command, run_pipeline,
+                           stage_print)
 
 default_zone = "europe-west2-c"
 default_shape = "n1-standard-1"
 default_branch = "master"
+ssh_timeout = 30 * 60
+ssh_port = int(os.environ.get("CITC_SSH_PORT", "22"))
+
+# The configuration of the other clouds in the CitC terraform repo, which
+# is not bundled for the management node
+other_providers = ["aws", "oracle"]
+terraform_repo = os.environ.get(
+    "CITC_TERRAFORM_GIT_URL",
+    "https://github.com/clusterinthecloud/terraform.git")
+
+# The image may have a checkout of the CitC terraform configuration and its
+# provider plugins built in
+baked_dir = os.environ.get("CITC_BAKED_DIR", "/opt/citc")
+baked_plugins = os.path.join(baked_dir, "plugins")
+
+if os.path.isdir(baked_plugins):
+    os.environ.setdefault("TF_PLUGIN_CACHE_DIR", baked_plugins)
 
 parser = argparse.ArgumentParser()
 
@@ -32,6 +62,21 @@ parser.add_argument("--branch", help=f"The branch used for CitC "
 
 parser.add_argument("--ansible-branch", help="The ansible branch to use")
 
+parser.add_argument("--bundle", help="Take the CitC terraform configuration, "
+                                     "terraform and its provider plugins "
+                                     "from an offline bundle made by 'citc "
+                                     "bundle export google'")
+
+parser.add_argument("--parallelism", type=int,
+                    help=f"How many resources terraform creates at once "
+                         f"(default one per resource in the configuration, "
+                         f"from 10 to {max_parallelism})")
+
+parser.add_argument("--metrics-file", help="Write the time taken by each "
+                                           "stage to this file, as "
+                                           "OpenMetrics if it ends in .prom "
+                                           "or else JSON")
+
 args = parser.parse_args()
 
 if args.dry_run:
@@ -39,42 +84,292 @@ if args.dry_run:
 else:
     dry = False
 
-last_stage = None
+gcloud_config.dry = dry
+
+stage_timings = []
+stage_keys = {}
+run_started = time.time()
+
+journal_file = "checkpoint_journal.json"
+
+def input_hash(*inputs):
+    """Hash the inputs of a stage, given as strings"""
+    digest = hashlib.sha256()
+
+    for value in inputs:
+        digest.update(str(value).encode() + b"\0")
+
+    return digest.hexdigest()
+
+def file_digest(*filenames):
+    """Hash the contents of 'filenames', treating missing files as empty"""
+    digest = hashlib.sha256()
+
+    for filename in filenames:
+        if os.path.exists(filename):
+            with open(filename, "rb") as FILE:
+                digest.update(FILE.read())
+
+        digest.update(b"\0")
+
+    return digest.hexdigest()
+
+def program_digest(name):
+    """Identify the installed version of the program 'name' by its path,
+       size and modification time, without running it
+    """
+    path = shutil.which(name)
+
+    if not path:
+        return ""
+
+    stat = os.stat(path)
+    return f"{path}:{stat.st_size}:{stat.st_mtime}"
+
+def read_journal():
+    """Return the hash of the inputs of each stage that completed in a
+       previous run, as recorded in the journal. The AWS installer keeps
+       the same format.
+    """
+    try:
+        with open(journal_file) as FILE:
+            return json.load(FILE)
+    except (OSError, ValueError):
+        return {}
+
+def legacy_checkpoint(stage):
+    """Return the marker file that installers from before the journal
+       wrote once 'stage' had completed
+    """
+    return f"checkpoint_{stage}.txt"
+
+def write_journal(journal):
+    """Replace the journal with 'journal', so that an interrupted write
+       never leaves it half written. Dry runs record nothing.
+    """
+    if dry:
+        return
 
-def has_completed(stage):
-    """Has the stage 'stage' completed yet? Returns True if it has, or else
-       False if it hasn't. Checking if 'stage' has completed implies that
-       any previous stage must have completed.
+    with open(journal_file + ".tmp", "w") as FILE:
+        FILE.write(json.dumps(journal, indent=2, sort_keys=True))
+
+    os.replace(journal_file + ".tmp", journal_file)
+
+def run_stages(stages):
+    """Run the stages in the dictionary 'stages', which maps each stage
+       name to a tuple of the names of the stages it depends on, a
+       function returning the stage's inputs as a list of strings and the
+       function that runs it, as gcloud_config.run_stages does.
+
+       The hash of a stage's inputs and of its dependencies' hashes is
+       recorded in the journal as each stage completes. A stage whose hash
+       matches the journal is skipped, so a re-run repeats only the stages
+       whose inputs have changed and the stages that depend on them. A stage
+       missing from the journal that has a legacy_checkpoint marker, left by
+       an install started with an older image, is also skipped, and the
+       journal takes over from the marker. The time taken by each stage is
+       recorded in stage_timings.
     """
-    global last_stage
+    journal = read_journal()
 
-    filename = f'checkpoint_{stage.replace(" ", "_")}.txt'
+    def skip(stage):
+        depends, inputs, func = stages[stage]
+        stage_keys[stage] = input_hash(*inputs(),
+                                       *[stage_keys[d] for d in depends])
 
-    if os.path.exists(filename):
-        return True
+        if journal.get(stage) == stage_keys[stage]:
+            stage_print(f"[{stage}] Inputs unchanged, skipping")
+            return True
 
-    if last_stage:
-        last_filename = f'checkpoint_{last_stage.replace(" ","_")}.txt'
-        with open(last_filename, "w") as FILE:
-            FILE.write("completed\n")
+        if stage not in journal and os.path.exists(legacy_checkpoint(stage)):
+            stage_print(f"[{stage}] Completed by an earlier version, "
+                        f"skipping")
+            journal[stage] = stage_keys[stage]
+            write_journal(journal)
 
-    last_stage = stage
-    return False
+            if not dry:
+                os.remove(legacy_checkpoint(stage))
 
-def run_command(cmd):
-    """Run the passed shell command"""
+            return True
+
+        return False
+
+    def completed(stage, timing):
+        journal[stage] = stage_keys[stage]
+        write_journal(journal)
+        stage_timings.append(timing)
+
+    gcloud_config.run_stages({stage: (depends, func) for stage, (depends,
+                              inputs, func) in stages.items()},
+                             skip, completed)
+
+def write_file(filename, lines):
+    """Write 'lines' to 'filename', or just show them in a dry run"""
     if dry:
-        print(f"[DRY-RUN] {cmd}")
+        stage_print(f"\n==={filename}===\n" + "\n".join(lines) + "\n")
+        return
+
+    with open(filename, "w") as FILE:
+        FILE.write("\n".join(lines) + "\n")
+
+def report_stage_timings(metrics_file):
+    """Print a table of the time taken by each stage that was run, and
+       write it to 'metrics_file' if given
+    """
+    print(f"{'STAGE':<24} {'WALL (s)':>10} {'SUBPROCESS (s)':>14}")
+
+    for timing in stage_timings:
+        print(f"{timing['stage']:<24} {timing['wall_seconds']:>10.2f} "
+              f"{timing['subprocess_seconds']:>14.2f}")
+
+    total = time.time() - run_started
+    print(f"{'total':<24} {total:>10.2f}\n")
+
+    if not metrics_file:
         return
 
-    print(f"[EXECUTE] {cmd}")
+    with open(metrics_file, "w") as FILE:
+        if not metrics_file.endswith(".prom"):
+            FILE.write(json.dumps({"stages": stage_timings}, indent=2))
+            return
+
+        for key in ["wall_seconds", "subprocess_seconds"]:
+            metric = f"citc_install_stage_{key}"
+            FILE.write(f"# TYPE {metric} gauge\n")
+
+            for timing in stage_timings:
+                FILE.write(f"{metric}{{stage=\"{timing['stage']}\"}} "
+                           f"{timing[key]}\n")
+
+        FILE.write("# EOF\n")
 
+def source_mirror(url):
+    """Return the path of the shared bare mirror of the git repo at 'url',
+       creating it or fetching any new commits into it. The mirror lives
+       in the same per-user cache as the AWS installer's source archives
+       so per-cluster checkouts only need a local clone.
+    """
+    name = url.split("github.com/")[-1].replace("/", "_")
+    mirror = os.path.join(citc_cache_dir(), "source", name)
+
+    if os.path.exists(mirror):
+        run_command(f"git --git-dir={mirror} remote update --prune")
+    else:
+        if not dry:
+            os.makedirs(os.path.dirname(mirror), exist_ok=True)
+
+        run_command(f"git clone --mirror {url} {mirror}")
+
+    return mirror
+
+def baked_checkout(branch):
+    """Return the path of the checkout of 'branch' of the CitC terraform
+       configuration built into the image, or None if the image has no
+       checkout or one of a different branch
+    """
     try:
-        args = shlex.split(cmd)
-        subprocess.run(args).check_returncode()
-    except Exception as e:
-        print(f"[ERROR] {e}")
-        sys.exit(-1)
+        with open(os.path.join(baked_dir, "terraform.branch")) as FILE:
+            if FILE.read().strip() == branch:
+                return os.path.join(baked_dir, "terraform")
+    except OSError:
+        pass
+
+    return None
+
+def unpack_bundle(filename):
+    """Unpack an offline bundle into the per-user cache, once per bundle,
+       and return its directory and the description of its contents. The
+       bundle has the same layout as the configuration built into the
+       image, with terraform in bin.
+    """
+    digest = hashlib.sha256()
+    with open(filename, "rb") as FILE:
+        for chunk in iter(lambda: FILE.read(1024 * 1024), b""):
+            digest.update(chunk)
+    bundle_dir = os.path.join(citc_cache_dir(), "bundles",
+                              digest.hexdigest()[:16])
+
+    if not os.path.isdir(bundle_dir):
+        os.makedirs(os.path.dirname(bundle_dir), exist_ok=True)
+        unpack_dir = tempfile.mkdtemp(dir=os.path.dirname(bundle_dir))
+        try:
+            with tarfile.open(filename) as tar:
+                tar.extractall(unpack_dir)
+            os.rename(unpack_dir, bundle_dir)
+        except OSError:
+            # Another installer unpacked the same bundle first
+            if not os.path.isdir(bundle_dir):
+                raise
+        finally:
+            shutil.rmtree(unpack_dir, ignore_errors=True)
+
+    with open(os.path.join(bundle_dir, "bundle.json")) as FILE:
+        return bundle_dir, json.load(FILE)
+
+def wait_for_ssh(host, deadline, port=22):
+    """Wait until 'host' accepts connections on 'port' and sends an SSH
+       banner, probing with jittered exponential backoff. Raises
+       RuntimeError if it is not ready by 'deadline' (a time.time() value).
+    """
+    delay = 0.1
+
+    while True:
+        remaining = deadline - time.time()
+
+        try:
+            with socket.create_connection((host, port),
+                                          timeout=max(0.1, min(5, remaining))) as sock:
+                if sock.recv(256).startswith(b"SSH-"):
+                    return
+        except OSError:
+            pass
+
+        jittered = random.uniform(delay / 2, delay)
+
+        if time.time() + jittered > deadline:
+            raise RuntimeError(f"Timed out waiting for SSH on {host}:{port}")
+
+        time.sleep(jittered)
+        delay = min(delay * 2, 1.0)
+
+def terraform_outputs(state_file="terraform.tfstate"):
+    """Return the outputs of the applied configuration as a dict of their
+       values. They are read straight from the state file, falling back to
+       a single 'terraform output -json' if there is none.
+    """
+    if os.path.exists(state_file):
+        with open(state_file) as FILE:
+            outputs = json.load(FILE).get("outputs", {})
+    else:
+        p = subprocess.run(["terraform", "output", "-json"],
+                           capture_output=True, check=True)
+        outputs = json.loads(p.stdout.decode())
+
+    return {name: output["value"] for name, output in outputs.items()}
+
+def bundle_files(top):
+    """Return the files, relative to 'top', that are needed to manage the
+       cluster from elsewhere: the SSH keys, the input parameters, and the
+       CitC terraform checkout with the google variables, credentials, lock
+       file and state. The git history, the other providers' configuration,
+       the install's journal and the providers in .terraform are left out,
+       as 'terraform init' fetches the providers again.
+    """
+    files = ["bundle_manifest.txt", "checkpoint_input.json",
+             ".ssh/citc-google", ".ssh/citc-google.pub"]
+
+    for root, dirs, names in os.walk(os.path.join(top, "terraform")):
+        if root == os.path.join(top, "terraform"):
+            dirs[:] = [d for d in dirs if d not in other_providers]
+            names = [name for name in names if not name.startswith(
+                journal_file)]
+
+        dirs[:] = sorted(d for d in dirs if d not in (".git", ".terraform"))
+
+        for name in sorted(names):
+            files.append(os.path.relpath(os.path.join(root, name), top))
+
+    return files
 
 def run_everything(args):
     """Function that runs everything in the script"""
@@ -86,6 +381,9 @@ def run_everything(args):
     branch = None
     ansible_branch = None
 
+    metrics_file = args.metrics_file
+    parallelism = args.parallelism
+
     checkpoint_file = "checkpoint_input.json"
 
     if os.path.exists(checkpoint_file):
@@ -161,12 +459,8 @@ def run_everything(args):
             ansible_branch = str(args.ansible_branch)
 
     if "CLOUDSDK_CONFIG" in os.environ:
-        project = subprocess.run(["gcloud", "config", "get-value", "core/project"], capture_output=True).stdout.decode().strip()
-        if project == "(unset)":
-            project = None
-        zone = subprocess.run(["gcloud", "config", "get-value", "compute/zone"], capture_output=True).stdout.decode().strip()
-        if zone == "(unset)":
-            zone = None
+        project = gcloud_property("core", "project")
+        zone = gcloud_property("compute", "zone")
 
     while not project:
         project = input("Which google project should the cluster be "
@@ -211,6 +505,8 @@ def run_everything(args):
             sys.exit(-1)
 
     if not cluster_name:
+        # Only needed for a new cluster, so not imported up front
+        import petname
         cluster_name = petname.generate()
 
     # save the checkpoint input - need to generate the cluster name
@@ -239,39 +535,50 @@ def run_everything(args):
     if dry:
         print("*** DRY RUN ***\n\n")
 
-    if os.path.exists("terraform"):
-        if not dry:
-            os.chdir("terraform")
-            print(os.getcwd())
+    baked = baked_checkout(branch)
+
+    if args.bundle and not baked:
+        raise RuntimeError(f"{args.bundle} holds the {default_branch} branch "
+                           f"of CitC, not {branch}")
 
-        run_command("git pull")
+    if baked:
+        print(f"Using the {branch} branch of CitC built into the image")
+
+        if not os.path.exists("terraform"):
+            run_command(f"cp -a {baked} terraform")
     else:
-        run_command(f"git clone --branch {branch} "
-                    f"https://github.com/clusterinthecloud/terraform.git")
+        mirror = source_mirror(terraform_repo)
 
-        if not dry:
-            os.chdir("terraform")
-            print(os.getcwd())
+        if os.path.exists("terraform"):
+            run_command(f"git -C terraform pull {mirror} {branch}")
+        else:
+            run_command(f"git clone --branch {branch} {mirror} terraform")
+            run_command(f"git -C terraform remote set-url origin "
+                        f"{terraform_repo}")
 
-    if not has_completed("gcloud_set_project"):
-        run_command(f"gcloud config set project {project}")
+    if not dry:
+        os.chdir("terraform")
+        print(os.getcwd())
+
+    if not gcloud_active_account():
+        # Logging in is interactive, so happens before any other stage
+        run_command("gcloud auth login", interactive=True)
 
-    if not subprocess.run(["gcloud", "auth", "list", "--filter=status:ACTIVE", "--format=value(account)"], capture_output=True).stdout.decode().strip():
-        if not has_completed("gcloud_login"):
-            run_command("gcloud auth login")
+    citc_name = f"citc-admin-{cluster_name}"
+
+    def gcloud_set_project():
+        run_command(f"gcloud config set project {project}")
 
-    if not has_completed("gcloud_enable_services"):
+    def gcloud_enable_services():
         run_command(f"gcloud services enable compute.googleapis.com "
                                         f"iam.googleapis.com "
                                         f"cloudresourcemanager.googleapis.com "
                                         f"file.googleapis.com")
 
-    citc_name = f"citc-admin-{cluster_name}"
-
-    if not has_completed("gcloud_add_account"):
+    def gcloud_add_account():
         # Create an account to run terraform - this shows that the user
         # has permission to run the subsequent steps. If these fail, then
-        # we can send back a meaningful error message
+        # we can send back a meaningful error message
         run_command(f"gcloud iam service-accounts create {citc_name} "
                                         f"--display-name {citc_name}")
 
@@ -290,111 +597,182 @@ def run_everything(args):
                     f"--iam-account "
                     f"{citc_name}@{project}.iam.gserviceaccount.com")
 
-    ####
-    #### Should have everything installed here and have sufficient
-    #### permission to run
-    ####
-
-    if not has_completed("generate_keys"):
+    def generate_keys():
         run_command(f"ssh-keygen -t rsa -f "
                     f"{os.environ['HOME']}/.ssh/citc-google "
                     f"-C provisioner -N \"\"")
 
-    if not has_completed("init_terraform"):
-        run_command("terraform init google")
-
-    if not has_completed("create_tfvars"):
-        # Now create the tfvars file
-        if dry:
-            print("\n===Creating the terraform.tfvars===")
-            FILE = sys.stdout
+    def init_terraform():
+        # The plugins built into the image match its checkout, so nothing
+        # needs downloading
+        if baked:
+            run_command(f"terraform init -plugin-dir="
+                        f"{baked_plugins}/linux_amd64 google")
         else:
-            FILE = open("terraform.tfvars", "w")
+            run_command("terraform init google")
 
-        FILE.write("# Google Cloud Platform Information\n")
-        FILE.write(f"region           = \"{region}\"\n")
-        FILE.write(f"zone             = \"{zone}\"\n")
-        FILE.write(f"project          = \"{project}\"\n")
-        FILE.write(f"management_shape = \"{login_shape}\"\n")
-        FILE.write(f"credentials      = \"citc-terraform-credentials.json\"\n")
-        FILE.write(f"private_key_path = \"~/.ssh/citc-google\"\n")
-        FILE.write(f"public_key_path  = \"~/.ssh/citc-google.pub\"\n")
+    # The tfvars file
+    tfvars = ["# Google Cloud Platform Information",
+              f"region           = \"{region}\"",
+              f"zone             = \"{zone}\"",
+              f"project          = \"{project}\"",
+              f"management_shape = \"{login_shape}\"",
+              f"credentials      = \"citc-terraform-credentials.json\"",
+              f"private_key_path = \"~/.ssh/citc-google\"",
+              f"public_key_path  = \"~/.ssh/citc-google.pub\""]
 
-        if ansible_branch:
-            FILE.write(f"ansible_branch   = \"{ansible_branch}\"\n")
+    if ansible_branch:
+        tfvars.append(f"ansible_branch   = \"{ansible_branch}\"")
 
-        FILE.write(f"cluster_id       = \"{cluster_name}\"\n")
+    tfvars.append(f"cluster_id       = \"{cluster_name}\"")
 
-        if dry:
-            print("\n")
-        else:
-            FILE.close()
+    def create_tfvars():
+        write_file("terraform.tfvars", tfvars)
 
-    if not has_completed("terraform_validate"):
+    def terraform_validate():
         run_command("terraform validate google")
 
-    if not has_completed("terraform_plan"):
-        run_command("terraform plan google")
+    # The plan is saved and exactly that plan is applied, so the refresh
+    # and plan are only done once
+    plan_file = "citc.tfplan"
 
-    if not has_completed("terraform_apply"):
-        run_command("terraform apply -auto-approve google")
+    if not parallelism:
+        parallelism = default_parallelism("google")
 
-    cmd = "terraform output -no-color -state=terraform.tfstate " \
-          "ManagementPublicIP"
+    def terraform_plan():
+        run_command(f"terraform plan -out={plan_file} "
+                    f"-parallelism={parallelism} google")
 
-    if dry:
-        print(f"[DRY-RUN] {cmd}")
-        cluster_ip = "192.168.0.1"
-    else:
-        print(f"[EXECUTE] {cmd}")
+    def terraform_apply():
+        # A plan is stale once applied, even in part, so is always removed.
+        # Plan again if a previous apply failed and removed it.
         try:
-            args = shlex.split(cmd)
-            p = subprocess.run(args, capture_output=True)
-            cluster_ip = p.stdout.decode("utf-8").strip()
-        except Exception as e:
-            print(f"[ERROR] {e}")
-            sys.exit(-1)
+            if not dry and not os.path.exists(plan_file):
+                terraform_plan()
+
+            run_command(f"terraform apply -parallelism={parallelism} "
+                        f"{plan_file}")
+        finally:
+            if os.path.exists(plan_file):
+                os.remove(plan_file)
 
-    if not has_completed("save_pubkey"):
+    def save_pubkey():
         # upload ${USER_PUBKEY} to citc-user .ssh folder
-        if dry:
-            FILE = sys.stdout
-            print("\n===Creating citc-admin.pub===")
-        else:
-            FILE = open("citc-admin.pub", "w")
+        write_file("citc-admin.pub", [user_pubkey])
 
-        FILE.write(f"{user_pubkey}\n")
+    ####
+    #### Everything up to creating the cluster. Stages run as soon as
+    #### the stages they depend on have completed, and are skipped if
+    #### neither their inputs nor those of their dependencies changed.
+    ####
 
-        if dry:
-            print("\n")
-        else:
-            FILE.close()
+    config_files = sorted(glob.glob("google/*.tf"))
+
+    run_stages({
+        "gcloud_set_project": ([], lambda: [project], gcloud_set_project),
+        "gcloud_enable_services": (["gcloud_set_project"], lambda: [],
+                                   gcloud_enable_services),
+        "gcloud_add_account": (["gcloud_enable_services"],
+                               lambda: [citc_name], gcloud_add_account),
+        "generate_keys": ([], lambda: [], generate_keys),
+        "init_terraform": ([], lambda: [branch, program_digest("terraform"),
+                                        file_digest(*config_files)],
+                           init_terraform),
+        "create_tfvars": ([], lambda: tfvars, create_tfvars),
+        "save_pubkey": ([], lambda: [user_pubkey], save_pubkey),
+        "terraform_validate": (["init_terraform", "create_tfvars"],
+                               lambda: [file_digest("terraform.tfvars")],
+                               terraform_validate),
+        "terraform_plan": (["terraform_validate", "gcloud_add_account",
+                            "generate_keys"],
+                           lambda: [file_digest(".terraform.lock.hcl")],
+                           terraform_plan),
+        "terraform_apply": (["terraform_plan"], lambda: [], terraform_apply),
+    })
 
-    scp_options = "-o StrictHostKeyChecking=no -i ~/.ssh/citc-google"
+    if dry:
+        print("[DRY-RUN] Read the outputs from terraform.tfstate")
+        cluster_ip = "192.168.0.1"
+    else:
+        try:
+            cluster_ip = terraform_outputs()["ManagementPublicIP"]
+        except Exception as e:
+            print(f"[ERROR] Unable to read the cluster IP address: {e}")
+            sys.exit(-1)
 
-    if not has_completed("upload_pubkey"):
-        run_command(f"scp {scp_options} citc-admin.pub "
-                    f"provisioner@{cluster_ip}:")
+    # Multiplex every copy to the management node over one SSH connection
+    control_dir = tempfile.mkdtemp(prefix="citc-ssh-")
+    scp_options = f"-o StrictHostKeyChecking=no -i ~/.ssh/citc-google " \
+                  f"-o ControlMaster=auto -o ControlPersist=60 " \
+                  f"-o ControlPath={control_dir}/%r@%h:%p"
 
-    if not has_completed("upload_terraform_files"):
+    def upload_pubkey():
         if not dry:
-            os.chdir("..")
-            print(os.getcwd())
+            stage_print(f"Waiting for SSH on {cluster_ip}")
+            wait_for_ssh(cluster_ip, time.time() + ssh_timeout, ssh_port)
 
-        run_command("tar -zcvf terraform.tgz .ssh "
-                    "terraform "
-                    "checkpoint_input.json")
-        run_command(f"scp {scp_options} terraform.tgz "
+        run_command(f"scp -P {ssh_port} {scp_options} citc-admin.pub "
                     f"provisioner@{cluster_ip}:")
 
+    def upload_terraform_files():
+        # The archive is of the directory above the terraform checkout. It
+        # is made as it is sent and only moved into place on the management
+        # node once all of it has arrived.
+        top = ".." if not dry else "."
+
+        write_file(f"{top}/bundle_manifest.txt", bundle_files(top))
+        run_pipeline(f"tar -zc -C {top} -T {top}/bundle_manifest.txt",
+                     f"ssh -p {ssh_port} {scp_options} "
+                     f"provisioner@{cluster_ip} "
+                     f"'cat > terraform.tgz.part && "
+                     f"mv terraform.tgz.part terraform.tgz'")
+
+    run_stages({
+        "upload_pubkey": (["terraform_apply", "save_pubkey"],
+                          lambda: [cluster_ip], upload_pubkey),
+        "upload_terraform_files": (["upload_pubkey"], lambda: [],
+                                   upload_terraform_files),
+    })
+
+    if not dry:
+        subprocess.run(shlex.split(f"ssh -O exit -p {ssh_port} {scp_options} "
+                                   f"provisioner@{cluster_ip}"),
+                       capture_output=True)
+
+    shutil.rmtree(control_dir, ignore_errors=True)
+
     print("\n\nYour Cluster-in-the-Cloud has now been created :-)")
     print("Proceed to the next stage. Connect to the cluster")
     print(f"by running 'ssh citc@{cluster_ip}'\n")
 
-    has_completed("everything")
+    report_stage_timings(metrics_file)
 
     return cluster_ip
 
+# An offline bundle takes the place of the configuration built into the image
+if args.bundle:
+    baked_dir, bundle = unpack_bundle(args.bundle)
+
+    if (bundle.get("format") != 1 or bundle.get("csp") != "google" or
+            bundle.get("platform") != "linux_amd64"):
+        print(f"[ERROR] {args.bundle} is not a bundle for this install")
+        sys.exit(-1)
+
+    # The configuration is written for Terraform 0.12, as in the image
+    if not str(bundle.get("terraform_version")).startswith("0.12."):
+        print(f"[ERROR] {args.bundle} holds Terraform "
+              f"{bundle.get('terraform_version')}, but this install "
+              f"needs Terraform 0.12")
+        sys.exit(-1)
+
+    baked_plugins = os.path.join(baked_dir, "plugins")
+    os.environ["TF_PLUGIN_CACHE_DIR"] = baked_plugins
+    os.environ["PATH"] = (os.path.join(baked_dir, "bin") + os.pathsep +
+                          os.environ["PATH"])
+    default_branch = bundle["branch"]
+    if not args.json and not args.branch:
+        args.branch = default_branch
+
 try:
     cluster_ip = run_everything(args)
 except Exception as e:
@@ -0,0 +1,272 @@
+#! /usr/bin/env python
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import json
+import os
+import os.path
+import subprocess
+import sys
+import threading
+from subprocess import call
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from citc_common import makedirs, print_table
+
+try:
+    # Python 2/3 compatibility
+    input = raw_input
+    string_types = basestring
+except NameError:
+    string_types = str
+
+INSTALLER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "install-citc.py")
+DESTROYER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "destroy-citc.py")
+
+# Cluster settings in the manifest and the install-citc.py options they map to
+INSTALL_OPTIONS = {
+    "region": "--region",
+    "availability_zone": "--availability_zone",
+    "profile": "--profile",
+    "terraform_repo": "--terraform-repo",
+    "terraform_branch": "--terraform-branch",
+    "ansible_repo": "--ansible-repo",
+    "ansible_branch": "--ansible-branch",
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage a fleet of Cluster in the Cloud clusters")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    install_parser = subparsers.add_parser("install", help="Create every cluster in a manifest")
+    install_parser.add_argument("manifest", help="JSON file listing the clusters to create")
+    install_parser.add_argument("--workdir", default="citc-fleet", help="Directory to hold a workspace for each cluster")
+    install_parser.add_argument("--concurrency", type=int, default=4, help="How many clusters to create at once")
+    install_parser.add_argument("--dry-run", help="Perform a dry run", action="store_true")
+    install_parser.set_defaults(func=install)
+
+    destroy_parser = subparsers.add_parser("destroy", help="Destroy many clusters at once")
+    destroy_parser.add_argument("--manifest", help="Destroy the clusters created from this manifest")
+    destroy_parser.add_argument("--cluster", nargs=3, action="append", default=[], metavar=("CSP", "IP", "KEY"), help="Destroy the cluster with this management node IP and SSH key (may be repeated)")
+    destroy_parser.add_argument("--workdir", default="citc-fleet", help="Directory holding the workspace for each cluster")
+    destroy_parser.add_argument("--concurrency", type=int, default=4, help="How many clusters to destroy at once")
+    destroy_parser.add_argument("--dry-run", help="Perform a dry run", action="store_true")
+    destroy_parser.set_defaults(func=destroy)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+def install(args):
+    clusters = load_manifest(args.manifest)
+
+    print("Installing {} clusters, {} at a time".format(len(clusters), args.concurrency))
+    results = run_pool(lambda cluster: install_cluster(cluster, args), clusters, args.concurrency)
+
+    print("")
+    print_table(
+        ["NAME", "STATUS", "IP", "CLUSTER ID", "KEY"],
+        [[r["name"], r["status"], r.get("ip", ""), r.get("cluster_id", ""), r.get("key", r["log"])] for r in results],
+    )
+    if any(r["status"] == "failed" for r in results):
+        exit(1)
+
+
+def destroy(args):
+    targets = []
+    if args.manifest:
+        for cluster in load_manifest(args.manifest):
+            workspace = os.path.abspath(os.path.join(args.workdir, cluster["name"]))
+            result_file = os.path.join(workspace, "result.json")
+            if not os.path.exists(result_file):
+                print("[{}] No installed cluster found in {}, skipping".format(cluster["name"], workspace))
+                continue
+            with open(result_file) as f:
+                details = json.load(f)
+            targets.append({
+                "name": cluster["name"],
+                "csp": details["csp"],
+                "ip": details["ip"],
+                "key": os.path.join(workspace, details["key"]),
+                "workspace": os.path.join(workspace, "destroy"),
+                "result_file": result_file,
+            })
+    for csp, ip, key in args.cluster:
+        targets.append({
+            "name": ip,
+            "csp": csp,
+            "ip": ip,
+            "key": os.path.abspath(key),
+            "workspace": os.path.abspath(os.path.join(args.workdir, "destroy-{}".format(ip))),
+        })
+    if not targets:
+        print("No clusters to destroy")
+        exit(1)
+
+    # Check that the user really meant it, once for the whole fleet
+    if not args.dry_run:
+        print("About to destroy:")
+        for target in targets:
+            print("  {} ({})".format(target["name"], target["ip"]))
+        proceed = input("Are you sure you want to destroy these {} clusters? [y/N]: ".format(len(targets)))
+        if proceed.lower() != "y":
+            exit(1)
+
+    print("Destroying {} clusters, {} at a time".format(len(targets), args.concurrency))
+    results = run_pool(lambda target: destroy_cluster(target, args), targets, args.concurrency)
+
+    print("")
+    print_table(["NAME", "IP", "STATUS", "LOG"], [[r["name"], r["ip"], r["status"], r["log"]] for r in results])
+    if any(r["status"] == "failed" for r in results):
+        exit(1)
+
+
+def load_manifest(path):
+    """Read the list of cluster specifications from a manifest file
+
+    The manifest is a JSON object with a "clusters" list. Each cluster needs a unique
+    "name", which is used for its workspace, and a "csp". The other keys are the
+    install-citc.py options in INSTALL_OPTIONS. Every value is a string.
+    """
+    with open(path) as f:
+        clusters = json.load(f)["clusters"]
+
+    names = set()
+    for cluster in clusters:
+        if not isinstance(cluster, dict) or not all(isinstance(value, string_types) for value in cluster.values()):
+            print("Every cluster in {} must be an object whose values are strings: {}".format(path, json.dumps(cluster)))
+            exit(1)
+        if "name" not in cluster or "csp" not in cluster:
+            print("Every cluster in {} needs a 'name' and a 'csp'".format(path))
+            exit(1)
+        if cluster["name"] in names:
+            print("Cluster name '{}' is used more than once in {}".format(cluster["name"], path))
+            exit(1)
+        unknown = set(cluster) - set(INSTALL_OPTIONS) - {"name", "csp"}
+        if unknown:
+            print("Unknown settings for cluster '{}': {}".format(cluster["name"], ", ".join(sorted(unknown))))
+            exit(1)
+        names.add(cluster["name"])
+    return clusters
+
+
+def install_cluster(cluster, args):
+    """Run install-citc.py for one cluster in its own workspace and return its result
+
+    Clusters whose workspace already holds a result are not created again, so a
+    manifest can be re-run to retry only the clusters which failed.
+    """
+    workspace = os.path.abspath(os.path.join(args.workdir, cluster["name"]))
+    result_file = os.path.join(workspace, "result.json")
+    log_file = os.path.join(workspace, "install.log")
+    result = {"name": cluster["name"], "log": log_file}
+
+    try:
+        if os.path.exists(result_file):
+            print("[{}] Already installed".format(cluster["name"]))
+            result["status"] = "existing"
+        else:
+            makedirs(workspace)
+            command = [sys.executable, INSTALLER, cluster["csp"], "--result-file", result_file]
+            for setting, option in sorted(INSTALL_OPTIONS.items()):
+                if setting in cluster:
+                    command.extend([option, cluster[setting]])
+            if args.dry_run:
+                command.append("--dry-run")
+
+            print("[{}] Installing, logging to {}".format(cluster["name"], log_file))
+            if run_logged(command, workspace, log_file) != 0:
+                print("[{}] Failed, see {}".format(cluster["name"], log_file))
+                result["status"] = "failed"
+                return result
+            print("[{}] Installed".format(cluster["name"]))
+            result["status"] = "installed"
+
+        with open(result_file) as f:
+            details = json.load(f)
+    except (EnvironmentError, ValueError) as e:
+        print("[{}] Failed: {}".format(cluster["name"], e))
+        result["status"] = "failed"
+        return result
+
+    result.update(ip=details["ip"], cluster_id=details["cluster_id"], key=os.path.join(workspace, details["key"]))
+    return result
+
+
+def destroy_cluster(target, args):
+    """Run destroy-citc.py for one cluster in its own workspace and return its result
+
+    The result file of a cluster created from a manifest is renamed once it has
+    been destroyed.
+    """
+    log_file = os.path.join(target["workspace"], "destroy.log")
+    result = {"name": target["name"], "ip": target["ip"], "log": log_file}
+
+    command = [sys.executable, DESTROYER, target["csp"], target["ip"], target["key"], "--yes"]
+    if args.dry_run:
+        command.append("--dry-run")
+
+    print("[{}] Destroying, logging to {}".format(target["name"], log_file))
+    try:
+        makedirs(target["workspace"])
+        returncode = run_logged(command, target["workspace"], log_file)
+    except EnvironmentError as e:
+        print("[{}] Failed: {}".format(target["name"], e))
+        result["status"] = "failed"
+        return result
+    if returncode != 0:
+        print("[{}] Failed, see {}".format(target["name"], log_file))
+        result["status"] = "failed"
+        return result
+
+    print("[{}] Destroyed".format(target["name"]))
+    result["status"] = "destroyed"
+    if "result_file" in target and not args.dry_run:
+        os.rename(target["result_file"], os.path.join(os.path.dirname(target["result_file"]), "destroyed.json"))
+    return result
+
+
+def run_logged(command, workspace, log_file):
+    """Run a command non-interactively in workspace, sending its output to log_file, and return its exit code"""
+    with open(log_file, "w") as log, open(os.devnull) as devnull:
+        return call(command, cwd=workspace, stdin=devnull, stdout=log, stderr=subprocess.STDOUT)
+
+
+def run_pool(func, items, concurrency):
+    """Call func on every item using up to concurrency threads and return the results in order
+
+    An item for which func raises is recorded as failed, so the others carry on.
+    """
+    results = [None] * len(items)
+    pending = queue.Queue()
+    for index, item in enumerate(items):
+        pending.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception as e:
+                print("[{}] Failed: {}".format(item["name"], e))
+                results[index] = {"name": item["name"], "ip": item.get("ip", ""), "log": "", "status": "failed"}
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, min(concurrency, len(items))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+if __name__ == "__main__":
+    main()
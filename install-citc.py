@@ -3,20 +3,37 @@
 from __future__ import print_function, unicode_literals
 
 import argparse
+import contextlib
+import hashlib
+import io
+import itertools
+import json
 import os
 import os.path
-import stat
+import re
+import resource
 import subprocess
-import sys
 import shutil
+import socket
 import tarfile
+import tempfile
+import threading
 import time
-from subprocess import call, check_call, check_output, CalledProcessError
+from subprocess import call, check_call, check_output
 try:
-    from urllib.request import urlretrieve
+    import queue
 except ImportError:
-    from urllib import urlretrieve
-from zipfile import ZipFile
+    import Queue as queue
+try:
+    from configparser import Error as ConfigParserError, RawConfigParser
+except ImportError:
+    from ConfigParser import Error as ConfigParserError, RawConfigParser
+
+from citc_common import (
+    BUNDLE_MANIFEST, BUNDLE_NAME, MAX_PARALLELISM, OFFLINE_BUNDLE_FORMAT, SSH_PORT, TERRAFORM_VERSION, backoff_delays,
+    cache_lock, cache_path, cached_terraform, config_hash, copy_tree, default_parallelism, fetch_source, file_sha256,
+    install_terraform, makedirs, terraform_init, terraform_platform, unpack_bundle,
+)
 
 
 def main():
@@ -30,74 +47,149 @@ def main():
     parser.add_argument("--terraform-branch", default="master", help="CitC Terraform branch to use")
     parser.add_argument("--ansible-repo", help="CitC Ansible repo to use")
     parser.add_argument("--ansible-branch", help="CitC Ansible branch to use")
+    parser.add_argument("--parallelism", type=int, help="How many resources Terraform creates at once (default: one per resource in the configuration, from 10 to {})".format(MAX_PARALLELISM))
+    parser.add_argument("--bundle", help="Take the configuration, Terraform and provider plugins from an offline bundle made by 'citc bundle export' instead of downloading them")
+    parser.add_argument("--validate-matrix", help="Instead of installing, check the configuration with every combination of settings in this JSON file")
+    parser.add_argument("--plan", help="With --validate-matrix, also run terraform plan for each combination", action="store_true")
+    parser.add_argument("--result-file", help="Write the details of the new cluster to this file as JSON")
+    parser.add_argument("--metrics-file", help="Write the time taken by each stage to this file, as OpenMetrics if it ends in .prom or else JSON")
     args = parser.parse_args()
 
-    print("Installing Cluster in the Cloud on AWS")
+    if args.validate_matrix:
+        combinations = load_matrix(args.validate_matrix)
+        workdir = "citc-validate"
+        print("Validating Cluster in the Cloud on AWS with {} combinations of settings".format(len(combinations)))
+    else:
+        workdir = "citc-terraform"
+        print("Installing Cluster in the Cloud on AWS")
 
-    if not args.dry_run:
-        try:
-            check_command = ["aws", "--dry-run", "ec2", "describe-images"]
-            if args.profile:
-                check_command.extend(["--profile", args.profile])
-            if args.region:
-                check_command.extend(["--region", args.region])
-            check_output(check_command, stderr=subprocess.STDOUT)
-        except CalledProcessError as e:
-            if "RequestExpired" in e.output.decode():
-                print("AWS credentials have expired:")
-            if "DryRunOperation" not in e.output.decode():
-                print(e.output.decode())
+    if args.bundle:
+        bundle_dir, bundle = unpack_bundle(args.bundle)
+        expected = {"format": OFFLINE_BUNDLE_FORMAT, "csp": args.csp, "terraform_version": TERRAFORM_VERSION, "platform": terraform_platform()}
+        for field, value in sorted(expected.items()):
+            if bundle.get(field) != value:
+                print("{} is not a bundle for this install: its {} is {}, not {}".format(args.bundle, field, bundle.get(field), value))
                 exit(1)
+        args.terraform_repo, args.terraform_branch = bundle["repo"], bundle["branch"]
+
+    # A matrix has no state to keep, so it always starts from a fresh configuration
+    if args.validate_matrix:
+        shutil.rmtree(workdir, ignore_errors=True)
 
-    # Download the CitC Terraform repo
-    print("Downloading CitC Terraform configuration")
-    tf_repo_tar, _ = urlretrieve("https://github.com/{repo}/archive/{branch}.tar.gz".format(repo=args.terraform_repo, branch=args.terraform_branch))
-    tarfile.open(tf_repo_tar).extractall()
-    shutil.rmtree("citc-terraform", ignore_errors=True)
-    os.rename("terraform-{branch}".format(branch=args.terraform_branch), "citc-terraform")
-    os.chdir("citc-terraform")
+    # An install which was interrupted is resumed, keeping its key and Terraform state
+    journal = Journal(os.path.join(workdir, JOURNAL_FILE))
+    source_key = input_hash(args.terraform_repo, args.terraform_branch)
+    if journal.stages:
+        print("Resuming in {}".format(workdir))
+        clear_config(workdir, args.csp, journal.unchanged("source", source_key))
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    new_key = not os.path.exists(os.path.join(workdir, "citc-key"))
 
-    terraform = download_terraform("1.0.3")
+    # Fetch everything needed before Terraform can run at the same time
+    stages.start("download")
+    key_dir = tempfile.mkdtemp()
+    if args.bundle:
+        print("Copying CitC Terraform configuration and Terraform binary from {}".format(args.bundle))
+        steps = [
+            ("copy CitC Terraform configuration from the bundle", lambda: copy_bundle_config(bundle_dir, workdir)),
+            ("find Terraform binary in the bundle", lambda: os.path.join(bundle_dir, "bin", "terraform")),
+        ]
+    else:
+        print("Downloading CitC Terraform configuration and Terraform binary")
+        steps = [
+            ("download CitC Terraform configuration", lambda: fetch_source(args.terraform_repo, args.terraform_branch, args.csp, workdir, download_progress)),
+            ("download Terraform binary", lambda: cached_terraform(TERRAFORM_VERSION, download_progress)),
+        ]
+    terraform_step = steps[1][0]
+    if new_key:
+        steps.append(("create SSH key", lambda: generate_key(os.path.join(key_dir, "citc-key"))))
+    if not args.dry_run and not args.validate_matrix:
+        steps.append(("check AWS credentials", lambda: check_aws_credentials(args)))
+    try:
+        results = run_concurrently(steps)
+    except StepFailed as e:
+        shutil.rmtree(key_dir, ignore_errors=True)
+        print("Failed to {}:".format(e.step))
+        print(e.error)
+        exit(1)
 
-    # Create key for admin and provisioning
-    if not os.path.isfile("citc-key"):
-        check_call(["ssh-keygen", "-t", "rsa", "-f", "citc-key", "-N", ""])
+    os.chdir(workdir)
+    journal.record("source", source_key)
+
+    terraform = install_terraform(results[terraform_step])
+
+    # Use the key for admin and provisioning
+    if new_key:
+        for key_file in ("citc-key", "citc-key.pub"):
+            shutil.move(os.path.join(key_dir, key_file), key_file)
+    os.rmdir(key_dir)
 
     # Intialise Terraform
-    check_call([terraform, "-chdir={}".format(args.csp), "init"])
-    check_call([terraform, "-chdir={}".format(args.csp), "validate"])
+    stages.start("init")
+    init_key = input_hash(args.terraform_repo, args.terraform_branch, TERRAFORM_VERSION, config_hash(args.csp))
+    if journal.unchanged("init", init_key) and os.path.isdir(os.path.join(args.csp, ".terraform")):
+        print("Terraform is already initialised")
+    else:
+        terraform_init(terraform, args.csp)
+        journal.record("init", init_key)
+    stages.start("validate")
+    if not journal.unchanged("validate", init_key):
+        check_call([terraform, "-chdir={}".format(args.csp), "validate"])
+        journal.record("validate", init_key)
+
+    if args.validate_matrix:
+        stages.start("matrix")
+        failed = check_matrix(terraform, args, combinations)
+        stages.finish()
+        exit(1 if failed else 0)
 
     # Set up the variable file
     config_file(args.csp, args)
 
     # Create the cluster
     if not args.dry_run:
-        check_call([terraform, "-chdir={}".format(args.csp), "apply", "-auto-approve"])
+        stages.start("apply")
+        apply_key = input_hash(init_key, file_digest(os.path.join(args.csp, "terraform.tfvars")), file_digest(os.path.join(args.csp, ".terraform.lock.hcl")))
+        if journal.unchanged("apply", apply_key) and os.path.exists(os.path.join(args.csp, "terraform.tfstate")):
+            print("The cluster is already up to date")
+        else:
+            terraform_apply(terraform, args.csp, args.parallelism or default_parallelism(args.csp))
+            journal.record("apply", apply_key)
 
         # Get the outputs
-        ip = check_output([terraform, "-chdir={}".format(args.csp), "output", "-no-color", "-raw", "-state=terraform.tfstate", "ManagementPublicIP"]).decode().strip().strip('"')
-        cluster_id = check_output([terraform, "-chdir={}".format(args.csp), "output", "-no-color", "-raw", "-state=terraform.tfstate", "cluster_id"]).decode().strip().strip('"')
+        stages.start("output")
+        outputs = terraform_outputs(terraform, args.csp)
+        ip = outputs["ManagementPublicIP"]
+        cluster_id = outputs["cluster_id"]
     else:
         print("... pretending to create the cluster ...")
         ip = "1.1.1.1"
         cluster_id = "test-cluster"
 
     # Upload the config to the cluster
+    stages.start("upload")
     os.chdir("..")
     new_dir_name = "citc-terraform-{}".format(cluster_id)
     os.rename("citc-terraform", new_dir_name)
 
     key_path = "{}/citc-key".format(new_dir_name)
 
-    shutil.rmtree(os.path.join(new_dir_name, args.csp, ".terraform"))
-    tf_zip = shutil.make_archive("citc-terraform", "gztar", ".", new_dir_name)
+    # The bundle is made as it is sent, so is never written out locally
     if not args.dry_run:
-        while call(["scp", "-i", key_path, "-o", "StrictHostKeyChecking no", "-o", "IdentitiesOnly=yes", tf_zip, "citc@{}:.".format(ip)]) != 0:
-            print("Trying to upload Terraform state...")
-            time.sleep(10)
+        if not upload_bundle_until(time.time() + UPLOAD_TIMEOUT, new_dir_name, args.csp, key_path, ip):
+            with open(BUNDLE_NAME, "wb") as f:
+                write_bundle(new_dir_name, args.csp, f)
+            print("Could not upload {} to the cluster. Upload it manually with:".format(BUNDLE_NAME))
+            print("  scp -P {} -i {} {} citc@{}:.".format(SSH_PORT, key_path, BUNDLE_NAME, ip))
+            exit(1)
     else:
-        print("... pretending to upload the config {} to the cluster ...".format(tf_zip))
-    os.remove(tf_zip)
+        print("... pretending to upload the config {} to the cluster ...".format(BUNDLE_NAME))
+    stages.finish()
+
+    if args.result_file:
+        with open(args.result_file, "w") as f:
+            json.dump({"csp": args.csp, "ip": ip, "cluster_id": cluster_id, "key": key_path, "directory": new_dir_name}, f)
 
     print("")
     print("#" * 80)
@@ -112,29 +204,530 @@ def main():
     print("You can destroy the cluster with:")
     print("  python destroy-citc.py {csp} {ip} {ssh_id}".format(csp=args.csp, ip=ip, ssh_id=key_path))
 
+    print("")
+    stages.print_summary()
+    if args.metrics_file:
+        stages.write(args.metrics_file)
+
+
+class StageTimer(object):
+    """Records the wall time, child process CPU time and bytes transferred of each install stage
+
+    Starting a stage finishes the one before it.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.current = None
+        self.lock = threading.Lock()
+
+    def start(self, name):
+        self.finish()
+        self.current = {"stage": name, "bytes": 0, "start": time.time(), "children": child_cpu_time()}
+
+    def finish(self):
+        if self.current is None:
+            return
+        stage = self.current
+        self.current = None
+        self.stages.append({
+            "stage": stage["stage"],
+            "wall_seconds": time.time() - stage["start"],
+            "subprocess_seconds": child_cpu_time() - stage["children"],
+            "bytes": stage["bytes"],
+        })
+
+    def add_bytes(self, count):
+        """Count bytes downloaded or uploaded, which may happen on several threads, against the current stage"""
+        with self.lock:
+            if self.current is not None:
+                self.current["bytes"] += count
+
+    def print_summary(self):
+        print("{:<10} {:>10} {:>14} {:>12}".format("STAGE", "WALL (s)", "SUBPROCESS (s)", "BYTES"))
+        for stage in self.stages:
+            print("{stage:<10} {wall_seconds:>10.2f} {subprocess_seconds:>14.2f} {bytes:>12}".format(**stage))
+        print("{:<10} {:>10.2f}".format("total", sum(stage["wall_seconds"] for stage in self.stages)))
+
+    def write(self, path):
+        if path.endswith(".prom"):
+            lines = []
+            for metric, key, description in [
+                ("citc_install_stage_wall_seconds", "wall_seconds", "Wall clock time of the install stage"),
+                ("citc_install_stage_subprocess_seconds", "subprocess_seconds", "CPU time used by commands run during the install stage"),
+                ("citc_install_stage_bytes", "bytes", "Bytes downloaded or uploaded during the install stage"),
+            ]:
+                lines.append("# TYPE {} gauge".format(metric))
+                lines.append("# HELP {} {}".format(metric, description))
+                for stage in self.stages:
+                    lines.append('{}{{stage="{}"}} {}'.format(metric, stage["stage"], stage[key]))
+            lines.append("# EOF")
+            with open(path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+        else:
+            with open(path, "w") as f:
+                json.dump({"stages": self.stages}, f, indent=2)
+
+
+def child_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+stages = StageTimer()
+
+
+# How long to keep trying to upload the Terraform state to a new cluster, in seconds
+UPLOAD_TIMEOUT = 30 * 60
+
+# The longest wait between upload attempts, in seconds. Each attempt is a full
+# SSH handshake, so they are spaced out more than the probes for the SSH port.
+UPLOAD_RETRY_MAX_DELAY = 30
+
+
+class SSHTimeout(RuntimeError):
+    """A host did not become ready for SSH in time"""
+
+
+def wait_for_ssh(host, deadline, port=22):
+    """Wait until host accepts connections on port and sends an SSH banner
+
+    Probes are repeated with jittered exponential backoff. SSHTimeout is raised
+    if the host is not ready by deadline, a time.time() value.
+    """
+    delays = backoff_delays()
+    while True:
+        remaining = deadline - time.time()
+        try:
+            sock = socket.create_connection((host, port), timeout=max(0.1, min(5, remaining)))
+            try:
+                if sock.recv(256).startswith(b"SSH-"):
+                    return
+            finally:
+                sock.close()
+        except (socket.error, socket.timeout):
+            pass
+        delay = next(delays)
+        if time.time() + delay > deadline:
+            raise SSHTimeout("Timed out waiting for SSH on {}:{}".format(host, port))
+        time.sleep(delay)
+
+
+PROBE_TTL = 5 * 60
+
+
+def check_aws_credentials(args):
+    """Check that there are AWS credentials for the chosen profile
+
+    Static keys in the environment or in the shared credentials and config files
+    are found without running anything. Other kinds of credentials, such as SSO,
+    assumed roles, instance profiles and keys with a session token, are checked
+    with the AWS CLI, and a successful check is remembered for PROBE_TTL seconds.
+    """
+    profile = args.profile or os.environ.get("AWS_PROFILE") or os.environ.get("AWS_DEFAULT_PROFILE") or "default"
+    probe_name = profile
+    if not args.profile and os.environ.get("AWS_ACCESS_KEY_ID") and os.environ.get("AWS_SECRET_ACCESS_KEY"):
+        if not os.environ.get("AWS_SESSION_TOKEN"):
+            return
+        # Temporary keys in the environment take precedence over the profile
+        probe_name = "env-" + os.environ["AWS_ACCESS_KEY_ID"]
+    elif aws_static_credentials(profile):
+        return
+
+    probe_file = cache_path("probes", "aws-{}".format(re.sub(r"[^A-Za-z0-9_.-]", "_", probe_name)))
+    if os.path.exists(probe_file) and time.time() - os.path.getmtime(probe_file) < PROBE_TTL:
+        return
+
+    check_command = ["aws", "--dry-run", "ec2", "describe-images"]
+    if args.profile:
+        check_command.extend(["--profile", args.profile])
+    if args.region:
+        check_command.extend(["--region", args.region])
+    returncode, output = step_output(check_command)
+    if returncode != 0 and "DryRunOperation" not in output:
+        if "RequestExpired" in output:
+            output = "AWS credentials have expired:\n" + output
+        raise RuntimeError(output)
+    with open(probe_file, "w"):
+        pass
+
+
+def aws_static_credentials(profile):
+    """Check whether a profile has long-lived keys in the shared credentials or config file
+
+    Profiles with a session token are not counted as the token may have expired.
+    """
+    for path, section in [
+        (os.environ.get("AWS_SHARED_CREDENTIALS_FILE") or os.path.expanduser("~/.aws/credentials"), profile),
+        (os.environ.get("AWS_CONFIG_FILE") or os.path.expanduser("~/.aws/config"), profile if profile == "default" else "profile " + profile),
+    ]:
+        config = RawConfigParser()
+        try:
+            config.read(path)
+        except ConfigParserError:
+            continue
+        if not config.has_section(section):
+            continue
+        options = dict(config.items(section))
+        if options.get("aws_access_key_id") and options.get("aws_secret_access_key") and not options.get("aws_session_token"):
+            return True
+    return False
+
+
+def generate_key(key_path):
+    """Create an SSH key pair for admin and provisioning"""
+    returncode, output = step_output(["ssh-keygen", "-t", "rsa", "-f", key_path, "-N", ""])
+    if returncode != 0:
+        raise RuntimeError(output)
+
+
+class StepFailed(Exception):
+    """One of the steps passed to run_concurrently raised an exception"""
+
+    def __init__(self, step, error):
+        super(StepFailed, self).__init__("{}: {}".format(step, error))
+        self.step = step
+        self.error = error
+
+
+class Cancelled(Exception):
+    """Raised inside a concurrent step when another step has failed"""
+
+
+cancelled = threading.Event()
+step_processes = []
+
+
+def run_concurrently(steps):
+    """Run a list of (name, function) steps on separate threads and return a dict of their results
+
+    The first step to fail cancels the others, killing any commands they have
+    running, and is raised as StepFailed once they have all stopped.
+    """
+    cancelled.clear()
+    results = {}
+    failures = []
+    finished = queue.Queue()
+
+    def run_step(name, func):
+        try:
+            results[name] = func()
+        except BaseException as e:
+            if not cancelled.is_set():
+                failures.append(StepFailed(name, e))
+                cancelled.set()
+        finally:
+            finished.put(name)
 
-def download_terraform(version):
-    """Download Terraform binary and return its path"""
+    for name, func in steps:
+        thread = threading.Thread(target=run_step, args=(name, func))
+        thread.daemon = True
+        thread.start()
 
-    if sys.platform.startswith("linux"):
-        tf_platform = "linux_amd64"
-    elif sys.platform == "darwin":
-        tf_platform = "darwin_amd64"
-    elif sys.platform == "win32":
-        raise NotImplementedError("Windows is not supported at the moment")
+    for _ in steps:
+        finished.get()
+        if cancelled.is_set():
+            for process in step_processes:
+                if process.poll() is None:
+                    process.terminate()
+    del step_processes[:]
+
+    if failures:
+        raise failures[0]
+    return results
+
+
+def check_cancelled():
+    if cancelled.is_set():
+        raise Cancelled()
+
+
+def step_output(command):
+    """Run a command from a concurrent step and return its exit code and combined output"""
+    check_cancelled()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    step_processes.append(process)
+    output = process.communicate()[0].decode()
+    check_cancelled()
+    return process.returncode, output
+
+
+def download_progress(count):
+    """Count the bytes a concurrent step downloads, stopping the download if another step failed"""
+    check_cancelled()
+    stages.add_bytes(count)
+
+
+# Records the inputs of each completed stage, in the same format as the Google installer
+JOURNAL_FILE = "checkpoint_journal.json"
+
+
+class Journal(object):
+    """The hash of the inputs of each stage which has completed
+
+    A stage whose inputs hash the same on a re-run does not need running again.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        try:
+            with open(self.path) as f:
+                self.stages = json.load(f)
+        except (IOError, ValueError):
+            self.stages = {}
+
+    def unchanged(self, stage, key):
+        return self.stages.get(stage) == key
+
+    def record(self, stage, key):
+        """Record that a stage completed, replacing the journal file so it is never left half written"""
+        self.stages[stage] = key
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.stages, f, indent=2, sort_keys=True)
+        os.rename(self.path + ".tmp", self.path)
+
+
+def clear_config(directory, csp, keep_plugins):
+    """Remove the configuration an interrupted install left in directory, so that it is extracted afresh
+
+    Only the SSH key, the journal and csp's state and lock file are kept, so no
+    files deleted upstream or from another branch are left behind. The provider
+    plugins in .terraform are also kept if keep_plugins, as when the repo and
+    branch are the same as before.
+    """
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name == csp and os.path.isdir(path):
+            for config_name in os.listdir(path):
+                if config_name.startswith("terraform.tfstate") or config_name == ".terraform.lock.hcl" or (keep_plugins and config_name == ".terraform"):
+                    continue
+                remove_path(os.path.join(path, config_name))
+        elif name not in ("citc-key", "citc-key.pub", JOURNAL_FILE):
+            remove_path(path)
+
+
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def input_hash(*inputs):
+    """Hash the inputs of a stage, given as strings"""
+    digest = hashlib.sha256()
+    for value in inputs:
+        digest.update(value.encode() + b"\0")
+    return digest.hexdigest()
+
+
+def file_digest(path):
+    """Hash a file which is an input to a stage, or return an empty string if it does not exist"""
+    return file_sha256(path) if os.path.exists(path) else ""
+
+
+def terraform_apply(terraform, csp, parallelism):
+    """Plan the changes for csp into a file and apply exactly that plan
+
+    Applying the saved plan means the refresh and plan are only done once. The
+    plan file holds the variables, including secrets, so it is always removed.
+    """
+    plan_file = "citc.tfplan"
+    try:
+        check_call([terraform, "-chdir={}".format(csp), "plan", "-out={}".format(plan_file), "-parallelism={}".format(parallelism)])
+        check_call([terraform, "-chdir={}".format(csp), "apply", "-parallelism={}".format(parallelism), plan_file])
+    finally:
+        if os.path.exists(os.path.join(csp, plan_file)):
+            os.remove(os.path.join(csp, plan_file))
+
+
+def terraform_outputs(terraform, csp):
+    """Return the outputs of the applied configuration for csp as a dict of their values
+
+    They are read straight from the local state file, falling back to a single
+    terraform output -json if there is none.
+    """
+    state_file = os.path.join(csp, "terraform.tfstate")
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            outputs = json.load(f).get("outputs", {})
     else:
-        raise NotImplementedError("Platform {platform} is not supported".format(platform=sys.platform))
+        outputs = json.loads(check_output([terraform, "-chdir={}".format(csp), "output", "-json"]).decode())
+    return dict((name, output["value"]) for name, output in outputs.items())
+
+
+def write_bundle(directory, csp, fileobj):
+    """Archive what is needed to manage a cluster from elsewhere as a gzipped tar stream into fileobj
+
+    That is the SSH key and everything extracted from the CitC Terraform archive,
+    including csp's variables, lock file and state, listed in a manifest with the
+    Terraform version. The Terraform binary and the provider plugins in .terraform
+    are left out as they can be fetched again, as is the local journal.
+    """
+    files = []
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if d != ".terraform")
+        if root == directory:
+            names = [name for name in names if name not in ("terraform", JOURNAL_FILE)]
+        files.extend(os.path.relpath(os.path.join(root, name), directory) for name in sorted(names))
+    manifest = json.dumps({"csp": csp, "terraform_version": TERRAFORM_VERSION, "files": files}, indent=2).encode()
+
+    top = os.path.basename(directory)
+    with contextlib.closing(tarfile.open(fileobj=fileobj, mode="w|gz")) as tar:
+        info = tarfile.TarInfo("{}/{}".format(top, BUNDLE_MANIFEST))
+        info.size = len(manifest)
+        info.mtime = time.time()
+        info.mode = 0o644
+        tar.addfile(info, io.BytesIO(manifest))
+        for name in files:
+            tar.add(os.path.join(directory, name), "{}/{}".format(top, name), recursive=False)
+
+
+def upload_bundle_until(deadline, directory, csp, key_path, ip):
+    """Upload the state bundle once the management node is ready for SSH, retrying until deadline
+
+    Returns whether the upload succeeded.
+    """
+    delays = backoff_delays(initial=1.0, maximum=UPLOAD_RETRY_MAX_DELAY)
+    try:
+        wait_for_ssh(ip, deadline, SSH_PORT)
+        while upload_bundle(directory, csp, key_path, ip) != 0:
+            delay = next(delays)
+            if time.time() + delay > deadline:
+                return False
+            print("Trying to upload Terraform state...")
+            time.sleep(delay)
+            wait_for_ssh(ip, deadline, SSH_PORT)
+    except SSHTimeout as e:
+        print(e)
+        return False
+    return True
+
+
+def upload_bundle(directory, csp, key_path, ip):
+    """Stream the state bundle for directory to the management node over ssh and return ssh's exit code
+
+    The node only moves the bundle into place once all of it has arrived, so an
+    interrupted upload never leaves a truncated one behind.
+    """
+    remote_command = "cat > {0}.part && mv {0}.part {0}".format(BUNDLE_NAME)
+    process = subprocess.Popen(["ssh", "-p", str(SSH_PORT), "-i", key_path, "-o", "StrictHostKeyChecking no", "-o", "IdentitiesOnly=yes", "citc@{}".format(ip), remote_command], stdin=subprocess.PIPE)
+    try:
+        write_bundle(directory, csp, ByteCounter(process.stdin))
+        process.stdin.close()
+    except EnvironmentError:
+        # ssh has gone away, and its exit code says why
+        try:
+            process.stdin.close()
+        except EnvironmentError:
+            pass
+    return process.wait()
+
+
+class ByteCounter(object):
+    """File-like wrapper which counts the bytes written through it against the current stage"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, data):
+        stages.add_bytes(len(data))
+        self.stream.write(data)
+
+
+def copy_bundle_config(bundle_dir, dest):
+    """Copy the configuration out of an unpacked offline bundle into dest
+
+    The bundle's provider plugins are added to the shared plugin cache, where
+    terraform_init will find them.
+    """
+    copy_tree(os.path.join(bundle_dir, "terraform"), dest)
+    with cache_lock("plugins"):
+        copy_tree(os.path.join(bundle_dir, "plugins"), cache_path("plugins", ""))
+
+
+# The settings which a --validate-matrix file can vary, in the order they name each combination
+MATRIX_SETTINGS = ("region", "availability_zone", "profile", "ansible_repo", "ansible_branch")
+
+# How many combinations are planned at once
+MATRIX_CONCURRENCY = 4
+
+
+def load_matrix(path):
+    """Read the combinations of settings to validate from a JSON file
+
+    The file holds either an object mapping settings in MATRIX_SETTINGS to lists
+    of values, every combination of which is used, or a list of objects each
+    giving one combination. A combination may be given a "name" for its files.
+    """
+    with open(path) as f:
+        matrix = json.load(f)
+    if isinstance(matrix, dict):
+        keys = sorted(matrix, key=lambda key: MATRIX_SETTINGS.index(key) if key in MATRIX_SETTINGS else len(MATRIX_SETTINGS))
+        matrix = [dict(zip(keys, values)) for values in itertools.product(*[matrix[key] for key in keys])]
+
+    combinations = []
+    for settings in matrix:
+        settings = dict(settings)
+        name = settings.pop("name", None) or "_".join(settings[key] for key in MATRIX_SETTINGS if key in settings) or "default"
+        unknown = set(settings) - set(MATRIX_SETTINGS)
+        if unknown:
+            print("Unknown settings in {}: {}".format(path, ", ".join(sorted(unknown))))
+            exit(1)
+        combinations.append({"name": re.sub(r"[^A-Za-z0-9_.-]", "_", name), "settings": settings})
+    if len(set(c["name"] for c in combinations)) != len(combinations):
+        print("Combinations in {} must have different names".format(path))
+        exit(1)
+    return combinations
+
+
+def check_matrix(terraform, args, combinations):
+    """Write the variables for every combination of settings and, with --plan, plan each one
+
+    terraform validate does not look at the variables, so it is only run once for
+    the whole matrix. The plans share the initialised configuration and run up to
+    MATRIX_CONCURRENCY at a time, without refreshing or writing any state. The
+    variables and plan output for each combination are left in the matrix
+    directory. Returns the names of the combinations which failed.
+    """
+    matrix_dir = os.path.join(args.csp, "matrix")
+    shutil.rmtree(matrix_dir, ignore_errors=True)
+    makedirs(matrix_dir)
+    for combination in combinations:
+        settings = argparse.Namespace(**vars(args))
+        for key in MATRIX_SETTINGS:
+            setattr(settings, key, combination["settings"].get(key, getattr(args, key)))
+        config_file(args.csp, settings, os.path.join(matrix_dir, combination["name"] + ".tfvars"))
+
+    results = dict((c["name"], "valid") for c in combinations)
+    if args.plan:
+        pending = queue.Queue()
+        for combination in combinations:
+            pending.put(combination["name"])
+
+        def worker():
+            while True:
+                try:
+                    name = pending.get_nowait()
+                except queue.Empty:
+                    return
+                command = [terraform, "-chdir={}".format(args.csp), "plan", "-input=false", "-lock=false", "-refresh=false", "-var-file=matrix/{}.tfvars".format(name)]
+                with open(os.path.join(matrix_dir, name + ".log"), "w") as log:
+                    returncode = call(command, stdout=log, stderr=subprocess.STDOUT)
+                results[name] = "planned" if returncode == 0 else "plan failed, see {}".format(os.path.join(matrix_dir, name + ".log"))
+
+        threads = [threading.Thread(target=worker) for _ in range(min(MATRIX_CONCURRENCY, len(combinations)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
-    tf_template = "https://releases.hashicorp.com/terraform/{v}/terraform_{v}_{p}.zip"
-    tf_url = tf_template.format(v=version, p=tf_platform)
-    print("Downloading Terraform binary")
-    tf_zip, _ = urlretrieve(tf_url)
-    ZipFile(tf_zip).extractall()
-    os.chmod("terraform", stat.S_IRWXU)
-    return "./terraform"
+    for combination in combinations:
+        print("  {}: {}".format(combination["name"], results[combination["name"]]))
+    return [name for name, result in results.items() if result not in ("valid", "planned")]
 
 
-def config_file(csp, args):
+def config_file(csp, args, path=None):
     with open(os.path.join(csp, "terraform.tfvars.example")) as f:
         config = f.read()
 
@@ -148,7 +741,7 @@ def config_file(csp, args):
     if args.ansible_branch:
         config = config + '\nansible_branch = "{}"'.format(args.ansible_branch)
 
-    with open(os.path.join(csp, "terraform.tfvars"), "w") as f:
+    with open(path or os.path.join(csp, "terraform.tfvars"), "w") as f:
         f.write(config)
 
 